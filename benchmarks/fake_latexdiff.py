@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Stand in for latexdiff, used by the benchmarks.
+
+File: benchmarks/fake_latexdiff.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+
+Produces the same kind of markup as latexdiff (word level \\DIFadd and \\DIFdel
+hunks and a preamble extension in files with \\begin{document}) so that no TeX
+installation is needed to benchmark zaphod.
+"""
+
+import difflib
+import re
+import sys
+
+PREAMBLE = (
+    "%DIF PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
+    + "\\providecommand{\\DIFadd}[1]{#1} %DIF PREAMBLE\n"
+    + "\\providecommand{\\DIFdel}[1]{} %DIF PREAMBLE\n"
+    + "\\providecommand{\\DIFaddbegin}{} %DIF PREAMBLE\n"
+    + "\\providecommand{\\DIFaddend}{} %DIF PREAMBLE\n"
+    + "\\providecommand{\\DIFdelbegin}{} %DIF PREAMBLE\n"
+    + "\\providecommand{\\DIFdelend}{} %DIF PREAMBLE\n"
+    + "%DIF END PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
+)
+
+
+def diff_words(old, new, output):
+    """Word level diff of two blocks of lines."""
+    oldwords = re.split(r"(\s+)", "".join(old))
+    newwords = re.split(r"(\s+)", "".join(new))
+    matcher = difflib.SequenceMatcher(None, oldwords, newwords, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal":
+            output.append("".join(newwords[j1:j2]))
+            continue
+        if i2 > i1:
+            output.append(
+                "\\DIFdelbegin \\DIFdel{" + "".join(oldwords[i1:i2]) + "}\\DIFdelend "
+            )
+        if j2 > j1:
+            output.append(
+                "\\DIFaddbegin \\DIFadd{" + "".join(newwords[j1:j2]) + "}\\DIFaddend "
+            )
+
+
+def main():
+    """Main runner."""
+    if "--version" in sys.argv:
+        print("This is LATEXDIFF 0.0 (zaphod benchmark stand in)")
+        return
+    files = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    with open(files[-2], "r") as thisfile:
+        old = thisfile.readlines()
+    with open(files[-1], "r") as thisfile:
+        new = thisfile.readlines()
+
+    # lines that are the same at the start and the end are not diffed
+    prefix = 0
+    while prefix < min(len(old), len(new)) and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < min(len(old), len(new)) - prefix
+        and old[-1 - suffix] == new[-1 - suffix]
+    ):
+        suffix += 1
+
+    output = ["".join(new[:prefix])]
+    # lines first, words only within changed blocks, to stay fast on big files
+    matcher = difflib.SequenceMatcher(
+        None, old[prefix : len(old) - suffix], new[prefix : len(new) - suffix]
+    )
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal":
+            output.append("".join(new[prefix + j1 : prefix + j2]))
+        else:
+            diff_words(
+                old[prefix + i1 : prefix + i2], new[prefix + j1 : prefix + j2], output
+            )
+    output.append("".join(new[len(new) - suffix :]))
+
+    text = "".join(output)
+    text = text.replace("\\begin{document}", PREAMBLE + "\\begin{document}", 1)
+    sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the hot paths of zaphod on synthetic LaTeX projects.
+
+File: benchmarks/run_benchmarks.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+
+Each scenario generates a git repository with two tagged revisions, rev1 and
+rev2, and then times, in a fresh clone for each repeat:
+
+    diff: Zaphod.diff between rev1 and rev2, without a pdf
+    scan-cold: get_modified_latex_files with no annotation index
+    scan-warm: get_modified_latex_files with an up to date index
+    revise: revise_file on every annotated file, with scripted answers
+    remove-preamble: remove_preamble once all files are revised
+
+Results are written to a JSON file that can be given to --compare in a later
+run to see how the timings changed.
+
+Usage:
+
+    python3 benchmarks/run_benchmarks.py --fake-latexdiff
+    python3 benchmarks/run_benchmarks.py --fake-latexdiff --scale 0.1 \\
+        --compare zaphod-benchmarks.json --output new.json
+"""
+
+import argparse
+import builtins
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from zaphodtex import __version__
+from zaphodtex.zaphod import Zaphod, _redirect_output
+
+# files: number of .tex files included from main.tex
+# paragraphs: paragraphs in each file
+# edits: "dense" edits every paragraph, "sparse" one paragraph in every tenth
+#   file
+# nested: each file includes the next, instead of main.tex including all
+# diff_args: extra arguments for zaphod diff
+SCENARIOS = {
+    "many-files": {"files": 400, "paragraphs": 10, "edits": "sparse"},
+    "large-file": {"files": 1, "paragraphs": 20000, "edits": "sparse"},
+    "dense-edits": {"files": 20, "paragraphs": 100, "edits": "dense"},
+    "sparse-edits": {"files": 20, "paragraphs": 100, "edits": "sparse"},
+    "deep-includes": {
+        "files": 100,
+        "paragraphs": 10,
+        "edits": "sparse",
+        "nested": True,
+        "diff_args": ["--follow-includes"],
+    },
+}
+
+WORDS = (
+    "neuron synapse model network spike dendrite axon membrane potential "
+    + "current channel simulation parameter result figure analysis method "
+    + "data the of and in to a is that with for as on by this we"
+).split()
+
+GIT_IDENTITY = {
+    "GIT_AUTHOR_NAME": "Zaphod Benchmarks",
+    "GIT_AUTHOR_EMAIL": "benchmarks@example.com",
+    "GIT_COMMITTER_NAME": "Zaphod Benchmarks",
+    "GIT_COMMITTER_EMAIL": "benchmarks@example.com",
+}
+
+
+def git(*args):
+    """Run a git command quietly."""
+    subprocess.check_call(["git"] + list(args), stdout=subprocess.DEVNULL)
+
+
+def paragraph(rng):
+    """Get a random paragraph."""
+    lines = []
+    for i in range(rng.randint(3, 6)):
+        lines.append(" ".join(rng.choice(WORDS) for j in range(rng.randint(8, 14))))
+    return "\n".join(lines) + "\n"
+
+
+def edit_paragraph(rng, text):
+    """Change a few words of a paragraph."""
+    words = text.split(" ")
+    for i in range(3):
+        words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return " ".join(words)
+
+
+def write_source(filename, sections):
+    """Write a list of sections, each a list of paragraphs, to a file."""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w") as thisfile:
+        for title, paragraphs, tail in sections:
+            thisfile.write(f"\\section{{{title}}}\n\n")
+            thisfile.write("\n".join(paragraphs))
+            thisfile.write(tail)
+
+
+def make_corpus(corpusdir, spec, scale, seed):
+    """Generate a git repository for a scenario.
+
+    :param corpusdir: directory to create the repository in
+    :param spec: scenario specification, see SCENARIOS
+    :param scale: factor that the number of files and paragraphs are scaled by
+    :param seed: seed for the random number generator
+    :returns: dict describing the corpus
+    """
+    rng = random.Random(seed)
+    nfiles = max(1, int(spec["files"] * scale))
+    nparagraphs = max(1, int(spec["paragraphs"] * scale))
+    nested = spec.get("nested", False)
+
+    os.makedirs(corpusdir)
+    cwd = os.getcwd()
+    os.chdir(corpusdir)
+    try:
+        git("init", "-q")
+        names = [f"chapters/chapter{i:04d}" for i in range(nfiles)]
+        sources = {}
+        for i, name in enumerate(names):
+            tail = ""
+            if nested and i + 1 < nfiles:
+                tail = f"\n\\input{{{names[i + 1]}}}\n"
+            sources[name] = [
+                f"Chapter {i}",
+                [paragraph(rng) for j in range(nparagraphs)],
+                tail,
+            ]
+
+        with open("main.tex", "w") as thisfile:
+            thisfile.write("\\documentclass{article}\n\\begin{document}\n")
+            for name in names[:1] if nested else names:
+                thisfile.write(f"\\input{{{name}}}\n")
+            thisfile.write("\\end{document}\n")
+
+        for name, section in sources.items():
+            write_source(name + ".tex", [section])
+        git("add", ".")
+        git("commit", "-q", "-m", "rev1")
+        git("tag", "rev1")
+
+        if spec["edits"] == "dense":
+            edited = names
+        else:
+            edited = names[::10]
+        for name in edited:
+            paragraphs = sources[name][1]
+            if spec["edits"] == "dense":
+                indices = range(len(paragraphs))
+            else:
+                indices = [rng.randrange(len(paragraphs))]
+            for j in indices:
+                paragraphs[j] = edit_paragraph(rng, paragraphs[j])
+            write_source(name + ".tex", [sources[name]])
+        git("commit", "-q", "-a", "-m", "rev2")
+        git("tag", "rev2")
+
+        size = sum(os.path.getsize(name + ".tex") for name in names + ["main"])
+    finally:
+        os.chdir(cwd)
+
+    return {
+        "files": nfiles + 1,
+        "paragraphs": nparagraphs,
+        "edited_files": len(edited),
+        "bytes": size,
+        "nested": nested,
+    }
+
+
+def make_zaphod(arguments, answers):
+    """Get a Zaphod instance with options parsed from arguments."""
+    # every instance adds a handler to the shared logger
+    logging.getLogger("zaphod").handlers.clear()
+    runner_instance = Zaphod()
+    runner_instance.setup()
+    runner_instance.optionsDict = vars(runner_instance.parser.parse_args(arguments))
+    runner_instance.answers.update(answers)
+    return runner_instance
+
+
+def timed(function, logfile):
+    """Run function with its output sent to logfile.
+
+    :returns: elapsed time in seconds and the return value of function
+    """
+    with _redirect_output(logfile):
+        start = time.perf_counter()
+        try:
+            value = function()
+        except SystemExit as E:
+            raise RuntimeError(f"zaphod exited with {E.code}, see {logfile}")
+        elapsed = time.perf_counter() - start
+    return elapsed, value
+
+
+def run_once(corpusdir, rundir, diffargs, answers):
+    """Time all operations once, in a new clone of the corpus.
+
+    :returns: dict of operation name to elapsed time, and number of hunks
+    """
+    subprocess.check_call(
+        ["git", "clone", "-q", corpusdir, rundir], stdout=subprocess.DEVNULL
+    )
+    logfile = rundir + ".log"
+    timings = {}
+    cwd = os.getcwd()
+    os.chdir(rundir)
+    try:
+        diffrunner = make_zaphod(
+            ["diff", "-r", "rev1", "-t", "rev2"] + diffargs, answers
+        )
+        timings["diff"], value = timed(lambda: diffrunner.diff(None), logfile)
+
+        zaphoddir = diffrunner.get_zaphod_dir()
+        shutil.rmtree(zaphoddir, ignore_errors=True)
+        reviserunner = make_zaphod(["revise"], answers)
+        timings["scan-cold"], filelist = timed(
+            reviserunner.get_modified_latex_files, logfile
+        )
+        reviserunner = make_zaphod(["revise"], answers)
+        timings["scan-warm"], filelist = timed(
+            reviserunner.get_modified_latex_files, logfile
+        )
+        hunks = sum(
+            len(entry["hunks"]) for entry in reviserunner.annotationindex.files.values()
+        )
+
+        # answers alternate, so that both branches of each hunk are taken
+        scripted = itertools.cycle(["y", "n"])
+        realinput = builtins.input
+        builtins.input = lambda prompt="": next(scripted)
+        try:
+            reviserunner.filelist = list(filelist)
+
+            def revise_all():
+                for filetorevise in filelist:
+                    reviserunner.revise_file(filetorevise)
+
+            timings["revise"], value = timed(revise_all, logfile)
+        finally:
+            builtins.input = realinput
+
+        timings["remove-preamble"], value = timed(reviserunner.remove_preamble, logfile)
+    finally:
+        os.chdir(cwd)
+
+    return timings, hunks
+
+
+def summarise(runs):
+    """Get the statistics of a list of timings."""
+    return {
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "max": max(runs),
+    }
+
+
+def package_commit():
+    """Get the commit of the zaphod sources being benchmarked, if known."""
+    try:
+        ps = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return ps.decode("ascii").strip()
+
+
+def compare(oldfile, results):
+    """Print the change in median times from an earlier run."""
+    with open(oldfile, "r") as thisfile:
+        old = json.load(thisfile)
+    print(f"Compared to {old.get('commit')} ({oldfile}):")
+    print(f"{'scenario':16} {'operation':16} {'old (s)':>10} {'new (s)':>10} ratio")
+    for scenario, result in results["scenarios"].items():
+        oldresult = old["scenarios"].get(scenario)
+        if oldresult is None:
+            continue
+        for operation, timing in result["timings"].items():
+            oldtiming = oldresult["timings"].get(operation)
+            if oldtiming is None:
+                continue
+            ratio = timing["median"] / oldtiming["median"]
+            print(
+                f"{scenario:16} {operation:16} {oldtiming['median']:10.4f} "
+                + f"{timing['median']:10.4f} {ratio:5.2f}"
+            )
+
+
+def main():
+    """Main runner."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark zaphod on synthetic LaTeX projects."
+    )
+    parser.add_argument(
+        "-s",
+        "--scenarios",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="Scenarios to run. Default: all",
+    )
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=3, help="Runs of each scenario"
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Factor to scale the number of files and paragraphs by",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument(
+        "--fake-latexdiff",
+        action="store_true",
+        help="Use a stand in for latexdiff, so that no TeX installation is needed",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=["latexdiff", "native", "auto"],
+        default="latexdiff",
+        help="Diff engine to use. Default: latexdiff",
+    )
+    parser.add_argument(
+        "--diff-args",
+        default="--no-cache",
+        help="Extra arguments for zaphod diff. Default: --no-cache",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="zaphod-benchmarks.json",
+        help="File to write results to. Default: zaphod-benchmarks.json",
+    )
+    parser.add_argument(
+        "-c", "--compare", help="Results of an earlier run to compare against"
+    )
+    parser.add_argument(
+        "-k", "--keep", action="store_true", help="Keep the generated repositories"
+    )
+    options = parser.parse_args()
+
+    os.environ.update(GIT_IDENTITY)
+    workdir = tempfile.mkdtemp(prefix="zaphod-benchmarks-")
+    if options.fake_latexdiff:
+        bindir = os.path.join(workdir, "bin")
+        os.makedirs(bindir)
+        os.symlink(
+            os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "fake_latexdiff.py"
+            ),
+            os.path.join(bindir, "latexdiff"),
+        )
+        os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    elif options.engine != "native" and not shutil.which("latexdiff"):
+        print("latexdiff not found, use --fake-latexdiff", file=sys.stderr)
+        sys.exit(1)
+
+    # no pdfs and no prompts
+    answers = {"pdf": "n", "commit": "n"}
+    results = {
+        "version": __version__,
+        "commit": package_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latexdiff": "fake" if options.fake_latexdiff else shutil.which("latexdiff"),
+        "repeat": options.repeat,
+        "scale": options.scale,
+        "engine": options.engine,
+        "diff_args": options.diff_args,
+        "scenarios": {},
+    }
+    try:
+        for scenario in options.scenarios:
+            corpusdir = os.path.join(workdir, scenario)
+            corpus = make_corpus(
+                corpusdir, SCENARIOS[scenario], options.scale, options.seed
+            )
+            runs = {}
+            for i in range(options.repeat):
+                timings, hunks = run_once(
+                    corpusdir,
+                    os.path.join(workdir, f"{scenario}-run{i}"),
+                    ["--engine", options.engine]
+                    + options.diff_args.split()
+                    + SCENARIOS[scenario].get("diff_args", []),
+                    answers,
+                )
+                for operation, elapsed in timings.items():
+                    runs.setdefault(operation, []).append(elapsed)
+            corpus["hunks"] = hunks
+            results["scenarios"][scenario] = {
+                "corpus": corpus,
+                "timings": {
+                    operation: summarise(elapsed) for operation, elapsed in runs.items()
+                },
+            }
+            print(
+                f"{scenario}: "
+                + ", ".join(
+                    f"{operation} {timing['median']:.3f}s"
+                    for operation, timing in results["scenarios"][scenario][
+                        "timings"
+                    ].items()
+                )
+            )
+    finally:
+        if options.keep:
+            print(f"Repositories kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(options.output, "w") as thisfile:
+        json.dump(results, thisfile, indent=2)
+    print(f"Results written to {options.output}")
+
+    if options.compare:
+        compare(options.compare, results)
+
+
+if __name__ == "__main__":
+    main()
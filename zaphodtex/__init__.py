@@ -9,8 +9,8 @@ Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
 try:
     import importlib.metadata
 
-    __version__ = importlib.metadata.version("zaphod")
+    __version__ = importlib.metadata.version("zaphodtex")
 except ImportError:
     import importlib_metadata
 
-    __version__ = importlib_metadata.version("zaphod")
+    __version__ = importlib_metadata.version("zaphodtex")
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+On disk caches for latexdiff output and built pdfs.
+
+File: zaphodtex/cache.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+
+
+def default_cache_dir():
+    """Get the default cache directory."""
+    cachehome = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cachehome, "zaphod")
+
+
+def git_blob_hash(filename):
+    """Get the git blob hash of a file, without calling git."""
+    with open(filename, "rb") as thisfile:
+        contents = thisfile.read()
+    blob = hashlib.sha1(f"blob {len(contents)}\0".encode("ascii"))
+    blob.update(contents)
+    return blob.hexdigest()
+
+
+def file_hash(filename):
+    """Get the sha256 hash of a file, or "missing" if it does not exist."""
+    filehash = hashlib.sha256()
+    try:
+        with open(filename, "rb") as thisfile:
+            for block in iter(lambda: thisfile.read(1024 * 1024), b""):
+                filehash.update(block)
+    except OSError:
+        return "missing"
+    return filehash.hexdigest()
+
+
+def _read_recorder(flsfile):
+    """Read a recorder file.
+
+    :returns: the build directory, and the sets of absolute paths of the
+        files that the run read and wrote
+    """
+    builddir = os.path.dirname(os.path.abspath(flsfile))
+    inputs = set()
+    outputs = set()
+    with open(flsfile, "r", errors="replace") as thisfile:
+        for line in thisfile:
+            kind, _, path = line.rstrip("\n").partition(" ")
+            if kind == "PWD":
+                builddir = path
+            elif kind == "INPUT":
+                inputs.add(os.path.normpath(os.path.join(builddir, path)))
+            elif kind == "OUTPUT":
+                outputs.add(os.path.normpath(os.path.join(builddir, path)))
+    return builddir, inputs, outputs
+
+
+def recorded_outputs(flsfile):
+    """Get the files in the build directory that a LaTeX run wrote.
+
+    :param flsfile: .fls file written by latexmk -recorder
+    :returns: sorted list of paths, relative to the build directory
+    """
+    builddir, inputs, outputs = _read_recorder(flsfile)
+    return sorted(
+        os.path.relpath(path, builddir)
+        for path in outputs
+        if os.path.commonpath([path, builddir]) == builddir
+    )
+
+
+def recorded_inputs(flsfile, jobname, outdir=None):
+    """Get the source files that a LaTeX run read, from its recorder file.
+
+    Files that the run wrote itself, the auxiliary files of the jobname, and
+    files in the output directory are build products, and are left out. The
+    bibliographies used by bibtex or biber are added, since LaTeX does not
+    read them.
+
+    :param flsfile: .fls file written by latexmk -recorder
+    :param jobname: jobname of the build
+    :param outdir: output directory of the build, if any
+    :returns: sorted list of paths, relative to the build directory where
+        they are in it, absolute otherwise
+    """
+    builddir, inputs, outputs = _read_recorder(flsfile)
+
+    auxdir = outdir or builddir
+    for extension, rx in [
+        (".aux", re.compile(r"\\bibdata\{([^}]*)\}")),
+        (".bcf", re.compile(r"<bcf:datasource[^>]*>([^<]*)</bcf:datasource>")),
+    ]:
+        try:
+            with open(os.path.join(auxdir, jobname + extension), "r") as thisfile:
+                contents = thisfile.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        for match in rx.finditer(contents):
+            for name in match.group(1).split(","):
+                name = name.strip()
+                if not name.endswith(".bib"):
+                    name += ".bib"
+                inputs.add(os.path.normpath(os.path.join(builddir, name)))
+
+    sources = []
+    for path in inputs - outputs:
+        if os.path.basename(path).startswith(jobname + "."):
+            continue
+        if outdir and os.path.commonpath([path, os.path.abspath(outdir)]) == (
+            os.path.abspath(outdir)
+        ):
+            continue
+        if os.path.commonpath([path, builddir]) == builddir:
+            path = os.path.relpath(path, builddir)
+        sources.append(path)
+    return sorted(sources)
+
+
+class LRUCache:
+    """
+    Size limited, content addressed cache of files on disk.
+
+    Entries are files named after their keys. When the cache grows beyond
+    its size limit, the least recently used entries are removed first.
+    Subclasses set the directory that entries are kept in, and the file that
+    hit and miss counts are kept in.
+    """
+
+    entryDirname: str
+    statsFilename: str
+
+    def __init__(self, cachedir, maxsize):
+        """Init method.
+
+        :param cachedir: directory to store the cache in
+        :param maxsize: maximum size of the cache in bytes
+        """
+        self.cachedir = os.path.abspath(cachedir)
+        self.entrydir = os.path.join(self.cachedir, self.entryDirname)
+        self.statsfile = os.path.join(self.cachedir, self.statsFilename)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def entry_path(self, key):
+        """Get the file an entry is stored in."""
+        return os.path.join(self.entrydir, key[:2], key)
+
+    def count(self, hit):
+        """Count a cache hit or miss."""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def copy_out(self, entry, outfile):
+        """Copy an entry to a file object, and mark it as used.
+
+        :returns: True if the entry exists, False if not
+        """
+        try:
+            with open(entry, "rb") as thisfile:
+                shutil.copyfileobj(thisfile, outfile)
+            # the modification time records when the entry was last used
+            os.utime(entry)
+        except OSError:
+            return False
+        return True
+
+    def copy_in(self, entry, filename):
+        """Store a copy of a file as an entry."""
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # write to a temporary file first so that concurrent runs never see
+        # partial entries
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(entry))
+        with os.fdopen(fd, "wb") as thisfile:
+            with open(filename, "rb") as inputfile:
+                shutil.copyfileobj(inputfile, thisfile)
+        os.replace(tmpname, entry)
+
+    def entries(self):
+        """Get a list of (path, size, last use) for all entries."""
+        entries = []
+        for root, dirs, files in os.walk(self.entrydir):
+            for filename in files:
+                entry = os.path.join(root, filename)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((entry, stat.st_size, stat.st_mtime))
+        return entries
+
+    def size(self):
+        """Get the total size of the cache in bytes."""
+        return sum([entry[1] for entry in self.entries()])
+
+    def prune(self, maxsize=None):
+        """Remove least recently used entries until the cache fits maxsize.
+
+        :returns: number of entries removed and number of bytes freed
+        """
+        if maxsize is None:
+            maxsize = self.maxsize
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum([entry[1] for entry in entries])
+        removed = 0
+        freed = 0
+        for entry, size, lastuse in entries:
+            if total <= maxsize:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+        return removed, freed
+
+    def load_stats(self):
+        """Get the hit and miss counts of all runs so far."""
+        try:
+            with open(self.statsfile, "r") as thisfile:
+                return json.load(thisfile)
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    def save_stats(self):
+        """Add the hit and miss counts of this run to the totals."""
+        stats = self.load_stats()
+        stats["hits"] = stats.get("hits", 0) + self.hits
+        stats["misses"] = stats.get("misses", 0) + self.misses
+        os.makedirs(self.cachedir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=self.cachedir)
+        with os.fdopen(fd, "w") as thisfile:
+            json.dump(stats, thisfile)
+        os.replace(tmpname, self.statsfile)
+
+
+class DiffCache(LRUCache):
+    """
+    Content addressed cache of latexdiff output.
+
+    Entries are keyed on the blob hashes of both revisions of a file, the
+    latexdiff options, and the latexdiff version.
+    """
+
+    entryDirname = "latexdiff"
+    statsFilename = "stats.json"
+
+    def key(self, rev1hash, rev2hash, options, version):
+        """Get the cache key for a latexdiff run."""
+        # so that '-t  UNDERLINE' and "-t UNDERLINE" share entries
+        options = " ".join(shlex.split(options))
+        key = hashlib.sha256()
+        for part in [rev1hash, rev2hash, options, version]:
+            key.update(part.encode("utf-8") + b"\0")
+        return key.hexdigest()
+
+    def get(self, key, outfile):
+        """Copy the cached output for key to outfile.
+
+        :param outfile: file object, opened for writing in binary mode
+        :returns: True if key was cached, False if not
+        """
+        found = self.copy_out(self.entry_path(key), outfile)
+        if not found:
+            outfile.seek(0)
+            outfile.truncate()
+        self.count(found)
+        return found
+
+    def put(self, key, filename):
+        """Store a copy of the output in filename in the cache."""
+        self.copy_in(self.entry_path(key), filename)
+
+
+class PdfCache(LRUCache):
+    """
+    Cache of built pdfs and their synctex files.
+
+    A build is identified by its jobname, main file and latexmk flags. For
+    each build, the cache remembers the lists of files that latexmk recorded
+    as inputs in earlier runs. Entries are keyed on the contents of all of
+    these files, so a build whose sources, packages, fonts and
+    bibliographies have not changed is restored instead of run again.
+
+    Synctex files record the absolute paths of the sources, which differ
+    between worktrees, so the build directory is replaced in them when
+    they are stored and restored.
+    """
+
+    entryDirname = "pdf"
+    statsFilename = "pdf-stats.json"
+    # placeholder for the build directory in stored synctex files
+    buildDirMarker = b"/<zaphod-build-dir>"
+    # input lists remembered for each build
+    maxInputLists = 4
+
+    def __init__(self, cachedir, maxsize):
+        """Init method.
+
+        :param cachedir: directory to store the cache in
+        :param maxsize: maximum size of the cache in bytes
+        """
+        super().__init__(cachedir, maxsize)
+        self.inputsdir = os.path.join(self.cachedir, "pdf-inputs")
+
+    def build_key(self, jobname, mainfile, flags):
+        """Get the key that identifies a build, whatever its inputs."""
+        key = hashlib.sha256()
+        for part in [jobname, mainfile] + list(flags):
+            key.update(part.encode("utf-8") + b"\0")
+        return key.hexdigest()
+
+    def key(self, buildkey, builddir, inputs):
+        """Get the cache key of a build from the current contents of inputs.
+
+        :param builddir: directory that relative input paths are in
+        """
+        key = hashlib.sha256(buildkey.encode("ascii") + b"\0")
+        for path in inputs:
+            filehash = file_hash(os.path.join(builddir, path))
+            key.update(f"{path}\0{filehash}\0".encode("utf-8"))
+        return key.hexdigest()
+
+    def input_lists(self, buildkey):
+        """Get the input lists recorded for a build, newest first."""
+        try:
+            with open(os.path.join(self.inputsdir, buildkey + ".json")) as thisfile:
+                return json.load(thisfile)
+        except (OSError, ValueError):
+            return []
+
+    def get(self, buildkey, builddir, pdf, synctex):
+        """Restore the pdf and synctex file of a build, if cached.
+
+        :param builddir: build directory, that the sources are in
+        :param pdf: file to restore the pdf to
+        :param synctex: file to restore the synctex file to
+        :returns: True if the build was cached, False if not
+        """
+        for inputs in self.input_lists(buildkey):
+            key = self.key(buildkey, builddir, inputs)
+            entry = self.entry_path(key)
+            if not os.path.isfile(entry + ".pdf"):
+                continue
+            with open(pdf + ".tmp", "wb") as thisfile:
+                found = self.copy_out(entry + ".pdf", thisfile)
+            if not found:
+                os.remove(pdf + ".tmp")
+                continue
+            os.replace(pdf + ".tmp", pdf)
+            # a synctex file of an older build would point to wrong lines
+            if os.path.isfile(synctex):
+                os.remove(synctex)
+            self.restore_synctex(entry + ".synctex.gz", builddir, synctex)
+            self.count(True)
+            return True
+
+        self.count(False)
+        return False
+
+    def put(self, buildkey, builddir, inputs, pdf, synctex, since=None):
+        """Store the pdf and synctex file of a build.
+
+        :param inputs: files that the build read, from recorded_inputs
+        :param since: time the build started: builds whose inputs were
+            changed after it are not stored, since the pdf may not match them
+        :returns: True if the build was stored, False if not
+        """
+        if since is not None:
+            for path in inputs:
+                try:
+                    if os.stat(os.path.join(builddir, path)).st_mtime > since:
+                        return False
+                except OSError:
+                    continue
+        entry = self.entry_path(self.key(buildkey, builddir, inputs))
+        self.copy_in(entry + ".pdf", pdf)
+        if os.path.isfile(synctex):
+            self.store_synctex(synctex, builddir, entry + ".synctex.gz")
+
+        inputlists = [inputs] + [
+            inputlist for inputlist in self.input_lists(buildkey) if inputlist != inputs
+        ]
+        os.makedirs(self.inputsdir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=self.inputsdir)
+        with os.fdopen(fd, "w") as thisfile:
+            json.dump(inputlists[: self.maxInputLists], thisfile)
+        os.replace(tmpname, os.path.join(self.inputsdir, buildkey + ".json"))
+        return True
+
+    def store_synctex(self, synctex, builddir, entry):
+        """Store a synctex file, with the build directory replaced."""
+        builddir = os.path.abspath(builddir).encode("utf-8")
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(entry))
+        with (
+            gzip.open(synctex, "rb") as inputfile,
+            os.fdopen(fd, "wb") as rawfile,
+            gzip.GzipFile(fileobj=rawfile, mode="wb") as thisfile,
+        ):
+            for line in inputfile:
+                if line.startswith(b"Input:"):
+                    line = line.replace(builddir, self.buildDirMarker)
+                thisfile.write(line)
+        os.replace(tmpname, entry)
+
+    def restore_synctex(self, entry, builddir, synctex):
+        """Restore a synctex file for a build directory.
+
+        :returns: True if the entry exists, False if not
+        """
+        builddir = os.path.abspath(builddir).encode("utf-8")
+        try:
+            with (
+                gzip.open(entry, "rb") as inputfile,
+                gzip.open(synctex, "wb") as thisfile,
+            ):
+                for line in inputfile:
+                    if line.startswith(b"Input:"):
+                        line = line.replace(self.buildDirMarker, builddir)
+                    thisfile.write(line)
+            os.utime(entry)
+        except OSError:
+            if os.path.isfile(synctex):
+                os.remove(synctex)
+            return False
+        return True
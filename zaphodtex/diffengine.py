@@ -0,0 +1,769 @@
+#!/usr/bin/env python3
+"""
+Engines that produce latexdiff annotated sources.
+
+File: zaphodtex/diffengine.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import concurrent.futures
+import difflib
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+
+class DiffDeclined(Exception):
+    """Raised when an engine can not annotate a pair of files."""
+
+
+def _native_annotate(options, text1, text2):
+    """Annotate a pair of texts with the native engine in a worker process."""
+    return NativeEngine(options).annotate(text1, text2)
+
+
+class LatexdiffEngine:
+    """Run latexdiff."""
+
+    name = "latexdiff"
+
+    # options that only change the markup, with their allowed values, or
+    # None for flags. Options that read or run other files, such as
+    # --preamble, --config and --filter-script, are left out.
+    safeOptions = {
+        "--type": [
+            "UNDERLINE",
+            "CTRADITIONAL",
+            "TRADITIONAL",
+            "CFONT",
+            "FONTSTRIKE",
+            "INVISIBLE",
+            "CHANGEBAR",
+            "CCHANGEBAR",
+            "CULINECHBAR",
+            "CFONTCHBAR",
+            "BOLD",
+            "PDFCOMMENT",
+        ],
+        "--subtype": [
+            "SAFE",
+            "MARGIN",
+            "COLOR",
+            "DVIPSCOL",
+            "ZLABEL",
+            "ONLYCHANGEDPAGE",
+            "LABEL",
+        ],
+        "--floattype": ["FLOATSAFE", "IDENTICAL", "TRADITIONALSAFE"],
+        "--math-markup": ["off", "whole", "coarse", "fine", "0", "1", "2", "3"],
+        "--graphics-markup": ["none", "new-only", "both", "0", "1", "2"],
+        "--disable-citation-markup": None,
+        "--enable-citation-markup": None,
+        "--allow-spaces": None,
+        "--no-del": None,
+    }
+
+    def __init__(self, options):
+        """Init method.
+
+        :param options: latexdiff options, as given on the command line
+        """
+        self.options = options
+        self.versionString = None
+
+    def set_pool(self, pool):
+        """Ignore the process pool: latexdiff runs in its own processes."""
+
+    @classmethod
+    def check_options(cls, options):
+        """Check that latexdiff options are all in safeOptions.
+
+        Options are split as in diff.
+
+        :raises ValueError: if an option or its value is not allowed
+        """
+        if not isinstance(options, str):
+            raise ValueError("must be of type str")
+        for option in options.split():
+            flag, equals, value = option.partition("=")
+            if flag not in cls.safeOptions:
+                raise ValueError(
+                    f"may only use the latexdiff options {', '.join(cls.safeOptions)}"
+                )
+            values = cls.safeOptions[flag]
+            if (values is None and equals) or (
+                values is not None and value not in values
+            ):
+                allowed = "no value" if values is None else ", ".join(values)
+                raise ValueError(f"{flag} takes {allowed}")
+
+    def version(self):
+        """Get the latexdiff version string, used in cache keys."""
+        if self.versionString is None:
+            try:
+                ps = subprocess.check_output(
+                    ["latexdiff", "--version"], stderr=subprocess.STDOUT
+                )
+                self.versionString = ps.decode("utf-8", errors="replace").strip()
+            except (subprocess.CalledProcessError, OSError):
+                self.versionString = ""
+        return self.versionString
+
+    def diff(self, rev1file, rev2file, outfile):
+        """Write the annotated version of rev2file to outfile.
+
+        The output of latexdiff goes straight to the file, and only its error
+        output is read.
+
+        :param outfile: file object, opened for writing in binary mode
+        :raises subprocess.CalledProcessError: if latexdiff fails
+        """
+        command = ["latexdiff"] + self.options.split() + [rev1file, rev2file]
+        outfile.flush()
+        ps = subprocess.run(command, stdout=outfile, stderr=subprocess.PIPE)
+        if ps.returncode != 0:
+            raise subprocess.CalledProcessError(
+                ps.returncode, command, stderr=ps.stderr
+            )
+
+
+class NativeEngine:
+    """
+    Word level diff in Python, for prose.
+
+    The markup is the same as that of latexdiff with --type=UNDERLINE, so the
+    output can be revised and built in the same way. Changes that latexdiff
+    has to treat specially are declined: changes to commands, math, verbatim
+    text, comments, or the preamble, changes inside arguments of commands
+    that are not text formatting commands, and changes inside environments
+    other than lists, floats and text blocks.
+    """
+
+    name = "native"
+    # increase when the output changes, so that cached output is not reused
+    engineVersion = "1"
+    # total size of the files to diff above which a process pool is used:
+    # diffs run at about half a megabyte per second, and starting a worker
+    # takes a fraction of a second
+    processThreshold = 4 * 1024 * 1024
+
+    preamble = (
+        "%DIF PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
+        + "%DIF UNDERLINE PREAMBLE %DIF PREAMBLE\n"
+        + "\\RequirePackage[normalem]{ulem} %DIF PREAMBLE\n"
+        + "\\RequirePackage{color}\\definecolor{RED}{rgb}{1,0,0}"
+        + "\\definecolor{BLUE}{rgb}{0,0,1} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFadd}[1]{{\\protect\\color{blue}\\uwave{#1}}}"
+        + " %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFdel}[1]{{\\protect\\color{red}\\sout{#1}}}"
+        + " %DIF PREAMBLE\n"
+        + "%DIF SAFE PREAMBLE %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFaddbegin}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFaddend}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFdelbegin}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFdelend}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFmodbegin}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFmodend}{} %DIF PREAMBLE\n"
+        + "%DIF FLOATSAFE PREAMBLE %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFaddFL}[1]{\\DIFadd{#1}} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFdelFL}[1]{\\DIFdel{#1}} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFaddbeginFL}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFaddendFL}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFdelbeginFL}{} %DIF PREAMBLE\n"
+        + "\\providecommand{\\DIFdelendFL}{} %DIF PREAMBLE\n"
+        + "%DIF END PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
+    )
+
+    # each token keeps the white space that follows it
+    rxToken = re.compile(
+        r"(?:(?P<comment>(?<!\\)%[^\n]*\n?)"
+        + r"|(?P<verbatim>\\begin\{(?P<venv>verbatim|lstlisting|minted|comment)"
+        + r"\*?\}.*?\\end\{(?P=venv)\*?\})"
+        + r"|(?P<math>\\begin\{(?P<menv>equation|align|alignat|gather|multline"
+        + r"|flalign|eqnarray|displaymath|math)\*?\}.*?\\end\{(?P=menv)\*?\}"
+        + r"|\\\[.*?\\\]|\\\(.*?\\\)|\$\$.*?\$\$|\$(?:\\.|[^$\\])+\$)"
+        + r"|(?P<command>\\(?:[A-Za-z@]+\*?|.))"
+        + r"|(?P<brace>[{}])"
+        + r"|(?P<prose>[^\s\\{}%$&#^_][^\\{}%$&#^_]*)"
+        + r"|(?P<space>\s+)"
+        + r"|(?P<other>.))(?P<trail>\s*)",
+        flags=re.DOTALL,
+    )
+    # in order of how common they are
+    kinds = [
+        "prose",
+        "command",
+        "brace",
+        "math",
+        "comment",
+        "verbatim",
+        "space",
+        "other",
+    ]
+    rxWord = re.compile(r"\S+\s*")
+    rxBrace = re.compile(r"[{}]")
+    rxParagraph = re.compile(r"\n\s*\n")
+    rxBeginDocument = re.compile(r"\\begin\s*\{document\}")
+
+    # commands and environments whose contents are text
+    textCommands = {
+        "\\textbf",
+        "\\textit",
+        "\\textsl",
+        "\\textsc",
+        "\\textsf",
+        "\\textrm",
+        "\\texttt",
+        "\\textup",
+        "\\textmd",
+        "\\emph",
+        "\\underline",
+        "\\footnote",
+        "\\part",
+        "\\chapter",
+        "\\section",
+        "\\subsection",
+        "\\subsubsection",
+        "\\paragraph",
+        "\\subparagraph",
+        "\\caption",
+    }
+    textEnvironments = {
+        "document",
+        "abstract",
+        "itemize",
+        "enumerate",
+        "description",
+        "quote",
+        "quotation",
+        "center",
+        "flushleft",
+        "flushright",
+        "figure",
+        "table",
+    }
+
+    def __init__(self, options, extension=None):
+        """Init method.
+
+        :param options: latexdiff options, as given on the command line.
+            Only the default markup type is supported.
+        :param extension: function that gets the preamble extension for the
+            preamble of a document, instead of the fixed one in preamble
+        """
+        self.options = options
+        self.extension = extension
+        # the diff is pure Python, so it only runs in parallel in processes
+        self.pool = None
+        self.unsupported = None
+        arguments = shlex.split(options)
+        if arguments not in [
+            [],
+            ["--type=UNDERLINE"],
+            ["--type", "UNDERLINE"],
+            ["-t", "UNDERLINE"],
+        ]:
+            self.unsupported = f"latexdiff options not supported: {options}"
+
+    def version(self):
+        """Get the version string, used in cache keys."""
+        return f"zaphod native engine {self.engineVersion}"
+
+    def set_pool(self, pool):
+        """Annotate in a process pool, or in this process if pool is None."""
+        self.pool = pool
+
+    def tokenize(self, text):
+        """Split text into tokens.
+
+        :returns: lists of token keys, without white space, token texts, with
+            white space, token kinds, and whether each token is in text where
+            changes can be marked up
+        """
+        keys = []
+        texts = []
+        kinds = []
+        safe = []
+        # brace groups: (command the group is an argument of, contents are text)
+        groups = [(None, True)]
+        environments = []
+        intext = True
+        # command that a following brace group is an argument of
+        pending = None
+        for match in self.rxToken.finditer(text):
+            for kind in self.kinds:
+                if match.group(kind) is not None:
+                    break
+
+            if kind == "prose":
+                # split into words here, which is much quicker than matching
+                # each word separately
+                words = self.rxWord.findall(match.group(0))
+                keys += [word.rstrip() for word in words]
+                texts += words
+                kinds += ["word"] * len(words)
+                safe += [intext and groups[-1][1]] * len(words)
+                # optional arguments, [...], do not end the arguments
+                if not (words[0].startswith("[") and keys[-1].endswith("]")):
+                    pending = None
+                continue
+
+            key = text[match.start() : match.start("trail")]
+            if kind == "command":
+                pending = key.rstrip("*")
+            elif kind == "brace" and key == "{":
+                groups.append(
+                    (
+                        pending,
+                        groups[-1][1]
+                        and (pending is None or pending in self.textCommands),
+                    )
+                )
+                pending = None
+            elif kind == "brace" and len(groups) > 1:
+                command = groups.pop()[0]
+                if command in ["\\begin", "\\end"] and keys[-2] == "{":
+                    name = keys[-1].rstrip("*")
+                    if command == "\\begin":
+                        environments.append(name)
+                    elif len(environments) > 0 and environments[-1] == name:
+                        environments.pop()
+                    intext = all([env in self.textEnvironments for env in environments])
+                # \href{url}{text}: the next group is the next argument
+                pending = command
+            else:
+                pending = None
+
+            keys.append(key)
+            texts.append(match.group(0))
+            kinds.append(kind)
+            safe.append(intext and groups[-1][1])
+        return keys, texts, kinds, safe
+
+    def check_block(self, tokens, i1, i2):
+        """Raise DiffDeclined if the tokens can not be marked up."""
+        keys, texts, kinds, safe = tokens
+        for i in range(i1, i2):
+            if kinds[i] not in ["word", "brace", "space"]:
+                raise DiffDeclined(f"changed {kinds[i]}: {keys[i][:40].strip()}")
+            if not safe[i]:
+                raise DiffDeclined(
+                    f"change in command argument: {keys[i][:40].strip()}"
+                )
+
+    def balanced(self, text):
+        """Check if the braces in text are balanced."""
+        depth = 0
+        for brace in self.rxBrace.findall(text):
+            depth += 1 if brace == "{" else -1
+            if depth < 0:
+                return False
+        return depth == 0
+
+    def markup(self, tokens, i1, i2, kind):
+        """Get the latexdiff markup for a block of added or deleted tokens.
+
+        Each paragraph gets its own \\DIFadd or \\DIFdel, since their
+        arguments can not contain paragraph breaks.
+        """
+        keys, texts, kinds, safe = tokens
+        command = "\\DIFadd" if kind == "add" else "\\DIFdel"
+        output = [f"\\DIF{kind}begin "]
+        segment = []
+        for i in range(i1, i2):
+            if self.rxParagraph.search(texts[i]) is None and i < i2 - 1:
+                segment.append(texts[i])
+                continue
+            trail = texts[i][len(keys[i]) :]
+            if self.rxParagraph.search(trail) is None:
+                segment.append(texts[i])
+                trail = ""
+            else:
+                segment.append(keys[i])
+            contents = "".join(segment)
+            if not self.balanced(contents):
+                raise DiffDeclined("change in braces")
+            if contents.strip():
+                output.append(command + "{" + contents + "}")
+            else:
+                output.append(contents)
+            output.append(trail)
+            segment = []
+        output.append(f"\\DIF{kind}end ")
+        return output
+
+    def diff_text(self, text1, text2):
+        """Get the annotated version of text2."""
+        tokens1 = self.tokenize(text1)
+        tokens2 = self.tokenize(text2)
+
+        # lines of tokens first, so that only changed lines are diffed word by
+        # word
+        lines1, starts1 = self.lines(tokens1)
+        lines2, starts2 = self.lines(tokens2)
+        output = []
+        matcher = difflib.SequenceMatcher(None, lines1, lines2)
+        for op, l1, l2, m1, m2 in matcher.get_opcodes():
+            i1, i2 = starts1[l1], starts1[l2]
+            j1, j2 = starts2[m1], starts2[m2]
+            if op == "equal":
+                output.append("".join(tokens2[1][j1:j2]))
+                continue
+
+            words = difflib.SequenceMatcher(
+                None, tokens1[0][i1:i2], tokens2[0][j1:j2], autojunk=False
+            )
+            for wordop, a1, a2, b1, b2 in words.get_opcodes():
+                if wordop == "equal":
+                    output.append("".join(tokens2[1][j1 + b1 : j1 + b2]))
+                    continue
+                if a2 > a1:
+                    self.check_block(tokens1, i1 + a1, i1 + a2)
+                    # text deleted at the end keeps the space before it in
+                    # rev1, for when the deletion is rejected
+                    if i1 + a1 > 0 and not "".join(output[-2:])[-1:].isspace():
+                        previous = i1 + a1 - 1
+                        output.append(tokens1[1][previous][len(tokens1[0][previous]) :])
+                    output += self.markup(tokens1, i1 + a1, i1 + a2, "del")
+                if b2 > b1:
+                    self.check_block(tokens2, j1 + b1, j1 + b2)
+                    output += self.markup(tokens2, j1 + b1, j1 + b2, "add")
+        return "".join(output)
+
+    def lines(self, tokens):
+        """Group tokens into lines.
+
+        :returns: list of lines, each a tuple of token keys, and the index of
+            the first token of each line, with the number of tokens at the end
+        """
+        keys, texts, kinds, safe = tokens
+        ends = [i + 1 for i, text in enumerate(texts) if "\n" in text]
+        if len(ends) == 0 or ends[-1] != len(keys):
+            ends.append(len(keys))
+        starts = [0] + ends
+        lines = [tuple(keys[starts[n] : ends[n]]) for n in range(0, len(ends))]
+        return lines, starts
+
+    def diff(self, rev1file, rev2file, outfile):
+        """Write the annotated version of rev2file to outfile.
+
+        Nothing is written if the files are declined.
+
+        :param outfile: file object, opened for writing in binary mode
+        :raises DiffDeclined: if the files contain changes that need latexdiff
+        """
+        if self.unsupported:
+            raise DiffDeclined(self.unsupported)
+        with open(rev1file, "rb") as thisfile:
+            text1 = thisfile.read().decode("utf-8", errors="surrogateescape")
+        with open(rev2file, "rb") as thisfile:
+            text2 = thisfile.read().decode("utf-8", errors="surrogateescape")
+
+        if self.pool is not None:
+            head, changedtext = self.pool.submit(
+                _native_annotate, self.options, text1, text2
+            ).result()
+        else:
+            head, changedtext = self.annotate(text1, text2)
+        if head is None:
+            head = ""
+        else:
+            head += self.extension(head) if self.extension else self.preamble
+        outfile.write(head.encode("utf-8", errors="surrogateescape"))
+        outfile.write(changedtext.encode("utf-8", errors="surrogateescape"))
+
+    def annotate(self, text1, text2):
+        """Annotate the changes between two texts.
+
+        :returns: the preamble of text2 without an extension, or None if it
+            is not a document, and the annotated text that follows it
+        :raises DiffDeclined: if the texts contain changes that need latexdiff
+        """
+        begin1 = self.rxBeginDocument.search(text1)
+        begin2 = self.rxBeginDocument.search(text2)
+        if begin1 is None and begin2 is None:
+            return None, self.diff_text(text1, text2)
+        if begin1 is None or begin2 is None:
+            raise DiffDeclined("\\begin{document} added or removed")
+        if text1[: begin1.start()] != text2[: begin2.start()]:
+            raise DiffDeclined("preamble changed")
+        return text2[: begin2.start()], self.diff_text(
+            text1[begin1.start() :], text2[begin2.start() :]
+        )
+
+
+class AutoEngine:
+    """
+    Use the native engine, and latexdiff for files that it declines.
+
+    Files that latexdiff annotates may use commands from any part of the
+    latexdiff preamble, such as the markup of graphics or listings, which
+    latexdiff picks from the packages that the document loads. So the
+    preamble extension of documents that the native engine annotates comes
+    from latexdiff too, by diffing their preamble with an empty body.
+    """
+
+    name = "auto"
+
+    def __init__(self, options):
+        """Init method.
+
+        :param options: latexdiff options, as given on the command line
+        """
+        self.native = NativeEngine(options, self.latexdiff_extension)
+        self.latexdiff = LatexdiffEngine(options)
+        self.counts = {"native": 0, "latexdiff": 0}
+        self.lock = threading.Lock()
+        self.extensions = {}
+
+    def version(self):
+        """Get the version string, used in cache keys."""
+        return (
+            self.native.version()
+            + "; "
+            + self.latexdiff.version()
+            + "; latexdiff preamble"
+        )
+
+    def set_pool(self, pool):
+        """Run the native engine in a process pool, or in this process."""
+        self.native.set_pool(pool)
+
+    def latexdiff_extension(self, head):
+        """Get the preamble extension that latexdiff adds to a preamble.
+
+        :raises DiffDeclined: if latexdiff fails, so that the whole file is
+            annotated by latexdiff
+        """
+        with self.lock:
+            if head in self.extensions:
+                return self.extensions[head]
+
+        stub = (head + "\\begin{document}\n\\end{document}\n").encode(
+            "utf-8", errors="surrogateescape"
+        )
+        with tempfile.TemporaryDirectory(prefix="zaphod-preamble-") as workdir:
+            stubfile = os.path.join(workdir, "preamble.tex")
+            with open(stubfile, "wb") as thisfile:
+                thisfile.write(stub)
+            outfilename = os.path.join(workdir, "preamble-changed.tex")
+            try:
+                with open(outfilename, "wb") as outfile:
+                    self.latexdiff.diff(stubfile, stubfile, outfile)
+            except (subprocess.CalledProcessError, OSError) as E:
+                raise DiffDeclined(f"latexdiff failed on the preamble: {E}")
+            with open(outfilename, "rb") as thisfile:
+                output = thisfile.read().decode("utf-8", errors="surrogateescape")
+
+        start = output.find("%DIF PREAMBLE EXTENSION ADDED BY LATEXDIFF")
+        endmarker = "%DIF END PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
+        end = output.rfind(endmarker)
+        if start == -1 or end < start:
+            raise DiffDeclined("latexdiff added no preamble extension")
+        extension = output[start : end + len(endmarker)]
+        with self.lock:
+            self.extensions[head] = extension
+        return extension
+
+    def diff(self, rev1file, rev2file, outfile):
+        """Write the annotated version of rev2file to outfile."""
+        try:
+            self.native.diff(rev1file, rev2file, outfile)
+            engine = "native"
+        except DiffDeclined:
+            # the native engine writes nothing to files that it declines
+            self.latexdiff.diff(rev1file, rev2file, outfile)
+            engine = "latexdiff"
+        with self.lock:
+            self.counts[engine] += 1
+
+
+class SectionEngine:
+    """
+    Diff large files in parts, in parallel.
+
+    Both revisions are split at \\part, \\chapter and \\section headings, or
+    at top level environments if there are no headings. Parts that are the
+    same in both revisions are passed through, and runs of changed parts are
+    diffed concurrently with the wrapped engine. The preamble extension comes
+    from diffing the preambles alone, so the output has just one.
+
+    The engine is called by the threads of the files and of their parts, so
+    a semaphore that they all share limits how many diffs run at once.
+    """
+
+    rxStructure = re.compile(
+        r"\\(part|chapter|section|begin|end)\b\*?\s*(?:\{([^}]*)\})?"
+    )
+    rxComment = re.compile(r"(?<!\\)%")
+
+    def __init__(self, engine, threshold, jobs):
+        """Init method.
+
+        :param engine: engine to diff the parts with
+        :param threshold: files smaller than this, in bytes, are diffed whole
+        :param jobs: number of files and parts to diff at the same time, in
+            total over all files
+        """
+        self.engine = engine
+        self.name = engine.name
+        self.counts = getattr(engine, "counts", None)
+        self.threshold = threshold
+        self.jobs = jobs
+        self.slots = threading.Semaphore(jobs)
+
+    def version(self):
+        """Get the version string, used in cache keys."""
+        return self.engine.version() + f"; sections over {self.threshold} bytes"
+
+    def set_pool(self, pool):
+        """Pass a process pool on to the wrapped engine."""
+        self.engine.set_pool(pool)
+
+    def run_engine(self, rev1file, rev2file, outfile):
+        """Diff with the wrapped engine once a slot is free."""
+        with self.slots:
+            return self.engine.diff(rev1file, rev2file, outfile)
+
+    def split(self, text):
+        """Get the start of each heading and each top level environment.
+
+        :returns: list of offsets of headings, list of offsets of top level
+            environments
+        """
+        headings = []
+        environments = []
+        depth = 0
+        for match in self.rxStructure.finditer(text):
+            linestart = text.rfind("\n", 0, match.start()) + 1
+            prefix = text[linestart : match.start()]
+            if self.rxComment.search(prefix):
+                continue
+            command, name = match.groups()
+            if name is not None and name.strip() == "document":
+                continue
+            if command == "begin":
+                if depth == 0 and prefix.strip() == "":
+                    environments.append(linestart)
+                depth += 1
+            elif command == "end":
+                depth = max(0, depth - 1)
+            elif depth == 0 and prefix.strip() == "":
+                headings.append(linestart)
+        return headings, environments
+
+    def parts(self, text, offsets):
+        """Split text at offsets."""
+        offsets = [0] + sorted(set(offsets) - {0}) + [len(text)]
+        return [
+            text[offsets[i] : offsets[i + 1]]
+            for i in range(0, len(offsets) - 1)
+            if offsets[i + 1] > offsets[i]
+        ]
+
+    def diff_part(self, workdir, number, text1, text2):
+        """Diff one pair of parts with the wrapped engine.
+
+        :returns: file that the annotated part was written to
+        """
+        rev1file = os.path.join(workdir, f"{number}-rev1.tex")
+        rev2file = os.path.join(workdir, f"{number}-rev2.tex")
+        with open(rev1file, "wb") as thisfile:
+            thisfile.write(text1.encode("utf-8", errors="surrogateescape"))
+        with open(rev2file, "wb") as thisfile:
+            thisfile.write(text2.encode("utf-8", errors="surrogateescape"))
+        outfilename = os.path.join(workdir, f"{number}-changed.tex")
+        with open(outfilename, "wb") as outfile:
+            self.run_engine(rev1file, rev2file, outfile)
+        return outfilename
+
+    def diff(self, rev1file, rev2file, outfile):
+        """Write the annotated version of rev2file to outfile."""
+        if max(os.path.getsize(rev1file), os.path.getsize(rev2file)) < self.threshold:
+            return self.run_engine(rev1file, rev2file, outfile)
+
+        with open(rev1file, "rb") as thisfile:
+            text1 = thisfile.read().decode("utf-8", errors="surrogateescape")
+        with open(rev2file, "rb") as thisfile:
+            text2 = thisfile.read().decode("utf-8", errors="surrogateescape")
+
+        begin1 = NativeEngine.rxBeginDocument.search(text1)
+        begin2 = NativeEngine.rxBeginDocument.search(text2)
+        if (begin1 is None) != (begin2 is None):
+            return self.run_engine(rev1file, rev2file, outfile)
+        head1 = text1[: begin1.end()] if begin1 else ""
+        head2 = text2[: begin2.end()] if begin2 else ""
+        body1 = text1[len(head1) :]
+        body2 = text2[len(head2) :]
+
+        headings1, environments1 = self.split(body1)
+        headings2, environments2 = self.split(body2)
+        if len(headings1) > 0 or len(headings2) > 0:
+            parts1 = self.parts(body1, headings1)
+            parts2 = self.parts(body2, headings2)
+        else:
+            parts1 = self.parts(body1, environments1)
+            parts2 = self.parts(body2, environments2)
+        if len(parts1) < 2 and len(parts2) < 2:
+            return self.run_engine(rev1file, rev2file, outfile)
+
+        # unchanged parts are kept as they are, each run of changed parts is
+        # diffed as one
+        output = []
+        matcher = difflib.SequenceMatcher(None, parts1, parts2, autojunk=False)
+        with tempfile.TemporaryDirectory(prefix="zaphod-sections-") as workdir:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs
+            ) as executor:
+                if begin2:
+                    # the diff of the preambles alone, for the preamble
+                    # extension and any changes to the preamble
+                    stub = "\n\\end{document}\n"
+                    output.append(
+                        executor.submit(
+                            self.diff_part, workdir, 0, head1 + stub, head2 + stub
+                        )
+                    )
+                opcodes = matcher.get_opcodes()
+                for number, (op, i1, i2, j1, j2) in enumerate(opcodes, start=1):
+                    if op == "equal":
+                        output.append("".join(parts2[j1:j2]))
+                    else:
+                        output.append(
+                            executor.submit(
+                                self.diff_part,
+                                workdir,
+                                number,
+                                "".join(parts1[i1:i2]),
+                                "".join(parts2[j1:j2]),
+                            )
+                        )
+
+                if begin2:
+                    with open(output.pop(0).result(), "rb") as thisfile:
+                        head = thisfile.read().decode("utf-8", errors="surrogateescape")
+                    begin = NativeEngine.rxBeginDocument.search(head)
+                    if begin is None:
+                        return self.run_engine(rev1file, rev2file, outfile)
+                    outfile.write(
+                        head[: begin.end()].encode("utf-8", errors="surrogateescape")
+                    )
+                for part in output:
+                    if isinstance(part, str):
+                        outfile.write(part.encode("utf-8", errors="surrogateescape"))
+                    else:
+                        with open(part.result(), "rb") as thisfile:
+                            shutil.copyfileobj(thisfile, outfile)
+
+
+ENGINES = {
+    "latexdiff": LatexdiffEngine,
+    "native": NativeEngine,
+    "auto": AutoEngine,
+}
@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+Backends that run the git operations of Zaphod.
+
+File: zaphodtex/gitbackend.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import os
+import posixpath
+import stat
+import subprocess
+import threading
+
+try:
+    import dulwich.errors
+    import dulwich.repo
+except ImportError:
+    dulwich = None
+
+
+class GitError(Exception):
+    """Raised when a git backend can not be used."""
+
+
+class _BatchProcess:
+    """
+    A long running "git cat-file" batch process.
+
+    Requests are answered one after another through the same process
+    instead of spawning git for each of them.
+    """
+
+    def __init__(self, mode):
+        """Init method.
+
+        :param mode: "--batch" to read objects, "--batch-check" to only look
+            them up
+        """
+        self.mode = mode
+        self.process = subprocess.Popen(
+            ["git", "cat-file", mode],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+
+    def request(self, spec):
+        """Look up spec.
+
+        :returns: (object name, object type, contents) for spec, where
+            contents is None in --batch-check mode, or None if spec is
+            missing or ambiguous
+        """
+        with self.lock:
+            self.process.stdin.write(spec.encode("utf-8") + b"\n")
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if header.endswith((b" missing\n", b" ambiguous\n")):
+                return None
+            objectname, objecttype, size = header.split()
+            contents = None
+            if self.mode == "--batch":
+                contents = self.process.stdout.read(int(size))
+                # each object is followed by a newline
+                self.process.stdout.read(1)
+            return objectname.decode("ascii"), objecttype.decode("ascii"), contents
+
+    def close(self):
+        """Stop the git process."""
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class GitBackend:
+    """
+    Run git in subprocesses.
+
+    Objects are read and revisions are resolved through long running
+    "git cat-file" batch processes, which are started when first needed.
+    All other operations run one git command each. Every git process that
+    is started is counted.
+
+    Paths are relative to the current directory, as for git commands.
+    """
+
+    name = "subprocess"
+
+    def __init__(self, tracer):
+        """Init method.
+
+        :param tracer: Tracer that subprocesses are run through
+        """
+        self.tracer = tracer
+        self.spawned = 0
+        self.batchSpawned = 0
+        self.batchProcesses = {}
+        self.commonDirs = {}
+        self.lock = threading.Lock()
+
+    def count(self):
+        """Count a git process that is about to be started."""
+        with self.lock:
+            self.spawned += 1
+
+    def call(self, args, **kwargs):
+        """Run git, and get its exit code."""
+        self.count()
+        return self.tracer.call(["git"] + args, **kwargs)
+
+    def check_call(self, args, **kwargs):
+        """Run git, and raise CalledProcessError if it fails."""
+        self.count()
+        return self.tracer.check_call(["git"] + args, **kwargs)
+
+    def check_output(self, args, **kwargs):
+        """Run git, and get its output."""
+        self.count()
+        return self.tracer.check_output(["git"] + args, **kwargs)
+
+    def batch(self, mode):
+        """Get the batch process for a mode, starting it if needed."""
+        with self.lock:
+            if mode not in self.batchProcesses:
+                self.spawned += 1
+                self.batchSpawned += 1
+                self.batchProcesses[mode] = _BatchProcess(mode)
+            return self.batchProcesses[mode]
+
+    def report(self):
+        """Get a summary of the git processes that were started."""
+        return (
+            f"Git ({self.name}): {self.spawned} subprocesses, "
+            + f"{self.batchSpawned} of them long running."
+        )
+
+    def close(self):
+        """Stop the batch processes."""
+        with self.lock:
+            processes = list(self.batchProcesses.values())
+            self.batchProcesses = {}
+        for process in processes:
+            process.close()
+
+    def rev_parse(self, rev):
+        """Get the commit a revision points to, or None if there is none."""
+        found = self.batch("--batch-check").request(rev + "^{commit}")
+        if found is None or found[1] != "commit":
+            return None
+        return found[0]
+
+    def read_file(self, rev, filename):
+        """Get the contents of a file in a revision, or None if it is missing."""
+        found = self.batch("--batch").request(f"{rev}:./{filename}")
+        if found is None:
+            return None
+        return found[2]
+
+    def read_object(self, objectname):
+        """Get the contents of an object."""
+        return self.batch("--batch").request(objectname)[2]
+
+    def common_dir(self):
+        """Get the git directory that is shared between all worktrees."""
+        cwd = os.getcwd()
+        if cwd not in self.commonDirs:
+            ps = self.check_output("rev-parse --git-common-dir".split())
+            self.commonDirs[cwd] = os.path.abspath(ps.decode("utf-8").strip())
+        return self.commonDirs[cwd]
+
+    def show_prefix(self):
+        """Get the path of the current directory in the repository."""
+        ps = self.check_output("rev-parse --show-prefix".split())
+        return ps.decode("utf-8").strip()
+
+    def status(self):
+        """Get the output of git status --porcelain."""
+        return self.check_output("status --porcelain".split())
+
+    def checkout(self, rev, branch=None):
+        """Check out a revision, in a new branch if one is given.
+
+        :raises subprocess.CalledProcessError: if it can not be checked out,
+            or the branch exists
+        """
+        args = ["checkout"]
+        if branch is not None:
+            args += ["-b", branch]
+        return self.check_call(args + [rev])
+
+    def reset_hard(self):
+        """Reset the index and working tree to HEAD."""
+        return self.check_call("reset HEAD --hard".split())
+
+    def create_branch(self, branch, start):
+        """Create a branch at start, without checking it out.
+
+        :raises subprocess.CalledProcessError: if the branch exists
+        """
+        return self.check_call(["branch", branch, start])
+
+    def stage(self, filelist):
+        """Add the current state of the given files to the index.
+
+        Only these files are looked at. Files that no longer exist are
+        removed from the index. Untracked files that are ignored, such as
+        build files, are left out, as git add does.
+
+        :raises subprocess.CalledProcessError: if the index can not be
+            updated
+        """
+        filelist = sorted(set(filelist) - self.ignored(filelist))
+        if len(filelist) == 0:
+            return
+        self.check_output(
+            "update-index --add --remove -z --stdin".split(),
+            input=b"".join(
+                filename.encode("utf-8", errors="surrogateescape") + b"\0"
+                for filename in filelist
+            ),
+        )
+
+    def ignored(self, filelist):
+        """Get the files in a list that are ignored and not tracked."""
+        if len(filelist) == 0:
+            return set()
+        try:
+            ps = self.check_output(
+                "check-ignore --stdin -z".split(),
+                input=b"".join(
+                    filename.encode("utf-8", errors="surrogateescape") + b"\0"
+                    for filename in filelist
+                ),
+            )
+        except subprocess.CalledProcessError as E:
+            # none of the files are ignored
+            if E.returncode == 1:
+                return set()
+            raise
+        return {
+            filename
+            for filename in ps.decode("utf-8", errors="surrogateescape").split("\0")
+            if filename
+        }
+
+    def commit(self, message):
+        """Commit the index."""
+        return self.call(["commit", "-m", message])
+
+    def list_blobs(self, rev, subdir):
+        """Get a dict of path to blob hash of the files in a revision.
+
+        :param subdir: only list files in this directory
+        """
+        ps = self.check_output(["ls-tree", "-r", "-z", rev, "--", subdir])
+        blobs = {}
+        for line in ps.decode("utf-8").split("\0"):
+            if "\t" not in line:
+                continue
+            info, filename = line.split("\t", 1)
+            mode, objecttype, objectname = info.split()
+            if objecttype == "blob":
+                blobs[filename] = objectname
+        return blobs
+
+    def changed_files(self, rev1, rev2, subdir):
+        """Get a dict of path to status, A, M or D, of files that differ."""
+        ps = self.check_output(
+            "diff-tree -r -z --name-status --no-renames --relative".split()
+            + [rev1, rev2, "--", subdir]
+        )
+        # output is a list of status, path pairs
+        fields = ps.decode("utf-8").split("\0")
+        changes = {}
+        for i in range(0, len(fields) - 1, 2):
+            changes[fields[i + 1]] = fields[i]
+        return changes
+
+    def rev_list(self, start, end):
+        """Get the commits after start up to end, oldest first.
+
+        Only the first parents of merges are followed, so that each commit
+        comes after the commit it was based on, and not after commits of
+        merged branches.
+        """
+        ps = self.check_output(
+            ["rev-list", "--reverse", "--first-parent", start + ".." + end]
+        )
+        return ps.decode("ascii").split()
+
+    def branches(self):
+        """Get (ref, object name, committer date) of all local branches."""
+        ps = self.check_output(
+            [
+                "for-each-ref",
+                "--format=%(refname)%00%(objectname)%00%(committerdate:unix)",
+                "refs/heads/",
+            ]
+        )
+        branches = []
+        for line in ps.decode("utf-8", errors="surrogateescape").splitlines():
+            ref, objectname, committerdate = line.split("\0")
+            branches.append((ref, objectname, float(committerdate or 0)))
+        return branches
+
+    def delete_refs(self, refs):
+        """Delete refs in a single transaction.
+
+        :param refs: list of (ref, object name) pairs: each ref is only
+            deleted if it still points to its object
+        :raises subprocess.CalledProcessError: if any ref can not be
+            deleted, in which case none are
+        """
+        transaction = ["start"]
+        for ref, objectname in refs:
+            transaction += [f"delete {ref}", objectname]
+        transaction += ["prepare", "commit"]
+        self.check_output(
+            "update-ref --stdin -z".split(),
+            input="\0".join(transaction).encode("utf-8", errors="surrogateescape")
+            + b"\0",
+        )
+
+    def worktree_add(self, path, start, branch=None):
+        """Check out start in a new worktree.
+
+        :param branch: new branch to create at start, or None to check out
+            start detached
+        """
+        args = ["worktree", "add", "--quiet"]
+        if branch is not None:
+            args += ["-b", branch]
+        else:
+            args += ["--detach"]
+        return self.check_call(args + [path, start])
+
+    def worktree_remove(self, path):
+        """Remove a worktree."""
+        return self.call(["worktree", "remove", "--force", path])
+
+    def worktree_branches(self):
+        """Get the refs of the branches checked out in any worktree."""
+        ps = self.check_output("worktree list --porcelain -z".split())
+        refs = set()
+        for field in ps.decode("utf-8", errors="surrogateescape").split("\0"):
+            if field.startswith("branch "):
+                refs.add(field[len("branch ") :])
+        return refs
+
+
+class DulwichBackend(GitBackend):
+    """
+    Read git objects in process with dulwich.
+
+    Files, trees and branches are read without starting git. Revisions are
+    still resolved by a git batch process, since dulwich does not know all
+    revision expressions. Operations on the working tree, the index,
+    worktrees and refs run git as in GitBackend.
+    """
+
+    name = "dulwich"
+
+    def __init__(self, tracer):
+        """Init method."""
+        if dulwich is None:
+            raise GitError(
+                "dulwich is required for the dulwich git backend: "
+                + "pip install zaphodtex[dulwich]"
+            )
+        super().__init__(tracer)
+        self.repos = {}
+
+    def repo(self):
+        """Get the repository of the current directory, and the path of the
+        current directory in it."""
+        cwd = os.getcwd()
+        if cwd not in self.repos:
+            repo = dulwich.repo.Repo.discover(cwd)
+            prefix = os.path.relpath(os.path.realpath(cwd), os.path.realpath(repo.path))
+            self.repos[cwd] = (repo, "" if prefix == "." else prefix)
+        return self.repos[cwd]
+
+    def commit_id(self, rev):
+        """Get the commit id of a revision as bytes, or None if there is none."""
+        if len(rev) != 40:
+            rev = self.rev_parse(rev)
+            if rev is None:
+                return None
+        return rev.encode("ascii")
+
+    def walk(self, repo, treeid, path):
+        """Yield (path, blob id) of all files in a tree and its subtrees."""
+        for entry in repo[treeid].items():
+            entrypath = posixpath.join(path, entry.path.decode("utf-8"))
+            if stat.S_ISDIR(entry.mode):
+                yield from self.walk(repo, entry.sha, entrypath)
+            elif stat.S_ISREG(entry.mode) or stat.S_ISLNK(entry.mode):
+                yield entrypath, entry.sha.decode("ascii")
+
+    def read_file(self, rev, filename):
+        """Get the contents of a file in a revision, or None if it is missing."""
+        commitid = self.commit_id(rev)
+        if commitid is None:
+            return None
+        repo, prefix = self.repo()
+        path = posixpath.normpath(posixpath.join(prefix, filename))
+        tree = repo[repo[commitid].tree]
+        try:
+            mode, blobid = tree.lookup_path(
+                repo.object_store.__getitem__, path.encode("utf-8")
+            )
+        except (KeyError, dulwich.errors.NotTreeError):
+            return None
+        blob = repo[blobid]
+        if blob.type_name != b"blob":
+            return None
+        return blob.as_raw_string()
+
+    def read_object(self, objectname):
+        """Get the contents of an object."""
+        repo, prefix = self.repo()
+        return repo[objectname.encode("ascii")].as_raw_string()
+
+    def list_blobs(self, rev, subdir):
+        """Get a dict of path to blob hash of the files in a revision.
+
+        :param subdir: only list files in this directory
+        """
+        commitid = self.commit_id(rev)
+        if commitid is None:
+            # let git report the error
+            return super().list_blobs(rev, subdir)
+        repo, prefix = self.repo()
+        path = posixpath.normpath(posixpath.join(prefix, subdir))
+        treeid = repo[commitid].tree
+        if path != ".":
+            try:
+                mode, treeid = repo[treeid].lookup_path(
+                    repo.object_store.__getitem__, path.encode("utf-8")
+                )
+            except (KeyError, dulwich.errors.NotTreeError):
+                return {}
+            if not stat.S_ISDIR(mode):
+                return {}
+        else:
+            path = ""
+        # paths relative to the current directory, as git prints them
+        relative = posixpath.relpath(path or ".", prefix or ".")
+        return {
+            posixpath.normpath(posixpath.join(relative, filename)): blobid
+            for filename, blobid in self.walk(repo, treeid, "")
+        }
+
+    def changed_files(self, rev1, rev2, subdir):
+        """Get a dict of path to status, A, M or D, of files that differ."""
+        blobs1 = self.list_blobs(rev1, subdir)
+        blobs2 = self.list_blobs(rev2, subdir)
+        changes = {}
+        for filename in set(blobs1) | set(blobs2):
+            if filename not in blobs1:
+                changes[filename] = "A"
+            elif filename not in blobs2:
+                changes[filename] = "D"
+            elif blobs1[filename] != blobs2[filename]:
+                changes[filename] = "M"
+        return changes
+
+    def branches(self):
+        """Get (ref, object name, committer date) of all local branches."""
+        repo, prefix = self.repo()
+        branches = []
+        for name, objectname in sorted(repo.refs.as_dict(b"refs/heads").items()):
+            commit = repo[objectname]
+            branches.append(
+                (
+                    "refs/heads/" + name.decode("utf-8", errors="surrogateescape"),
+                    objectname.decode("ascii"),
+                    float(getattr(commit, "commit_time", 0)),
+                )
+            )
+        return branches
+
+
+BACKENDS = {
+    "subprocess": GitBackend,
+    "dulwich": DulwichBackend,
+}
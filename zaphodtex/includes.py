@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Find the sources of a LaTeX document by following its includes.
+
+File: zaphodtex/includes.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+
+class IncludeGraph:
+    """
+    Graph of the files included by a LaTeX document.
+
+    Files are followed through \\input, \\include, \\subfile, \\import and
+    \\subimport. The includes found in a file are cached by the hash of its
+    contents, so files that have not changed are not parsed again.
+    """
+
+    rxComment = re.compile(r"(?<!\\)%[^\n]*")
+    rxInclude = re.compile(
+        r"\\(input|include|subfile|import|subimport)\*?\s*\{([^}]*)\}"
+        + r"(?:\s*\{([^}]*)\})?"
+    )
+
+    def __init__(self, cachefile):
+        """Init method.
+
+        :param cachefile: file that parsed includes are stored in
+        """
+        self.cachefile = cachefile
+        self.parsed = 0
+        self.changed = False
+        try:
+            with open(self.cachefile, "r") as thisfile:
+                self.cache = json.load(thisfile)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def parse(self, contents):
+        """Get the list of [command, argument, argument] includes in contents."""
+        key = hashlib.sha1(contents).hexdigest()
+        if key in self.cache:
+            return self.cache[key]
+
+        text = self.rxComment.sub("", contents.decode("utf-8", errors="replace"))
+        includes = []
+        for match in self.rxInclude.finditer(text):
+            command, first, second = match.groups()
+            # only \import and \subimport take a directory and a file
+            if command not in ["import", "subimport"]:
+                second = None
+            elif second is None:
+                continue
+            includes.append([command, first.strip(), (second or "").strip()])
+
+        self.cache[key] = includes
+        self.parsed += 1
+        self.changed = True
+        return includes
+
+    def files(self, mainfile, read):
+        """Get all .tex files reachable from mainfile.
+
+        :param mainfile: path of the main file
+        :param read: function that returns the contents of a path as bytes,
+            or None if it does not exist
+        :returns: sorted list of normalised paths
+        """
+        mainfile = os.path.normpath(mainfile)
+        return self.reachable(mainfile, os.path.dirname(mainfile), read)
+
+    def units(self, mainfile, read):
+        """Get the files of each \\include'd unit of a document.
+
+        \\include commands in the main file and in the files that it inputs
+        are found, but not those in included units, which LaTeX does not
+        allow.
+
+        :param mainfile: path of the main file
+        :param read: function that returns the contents of a path as bytes,
+            or None if it does not exist
+        :returns: dict of the argument of each \\include, as given in the
+            sources and in \\includeonly, to the sorted list of normalised
+            paths of the files of the unit
+        """
+        mainfile = os.path.normpath(mainfile)
+        maindir = os.path.dirname(mainfile)
+        units = {}
+        self.reachable(mainfile, maindir, read, units)
+        return {
+            unit: self.reachable(target, maindir, read)
+            for unit, target in units.items()
+        }
+
+    def reachable(self, start, maindir, read, units=None):
+        """Get all .tex files reachable from start.
+
+        :param start: path of the file to start from
+        :param maindir: directory of the main file, that includes in start
+            are relative to
+        :param read: function that returns the contents of a path as bytes,
+            or None if it does not exist
+        :param units: if given, \\include commands are not followed, and the
+            path of each included file is added to units by its argument
+        :returns: sorted list of normalised paths
+        """
+        # each file is followed with the directory its includes are relative to
+        pending = [(start, maindir)]
+        found = {}
+        while len(pending) > 0:
+            filename, base = pending.pop()
+            if filename in found:
+                continue
+            contents = read(filename)
+            if contents is None:
+                continue
+            found[filename] = True
+
+            for command, first, second in self.parse(contents):
+                if command == "import":
+                    childbase = os.path.normpath(os.path.join(maindir, first))
+                    target = os.path.join(childbase, second)
+                elif command == "subimport":
+                    childbase = os.path.normpath(os.path.join(base, first))
+                    target = os.path.join(childbase, second)
+                else:
+                    childbase = base
+                    target = os.path.join(base, first)
+
+                target = os.path.normpath(target)
+                if not target.endswith(".tex"):
+                    target += ".tex"
+                # subfiles are relative to their own directory
+                if command == "subfile":
+                    childbase = os.path.dirname(target)
+                if command == "include" and units is not None:
+                    units[first] = target
+                    continue
+                pending.append((target, childbase))
+
+        return sorted(found)
+
+    def save(self):
+        """Write the parsed includes to disk, if new files were parsed."""
+        if not self.changed:
+            return
+        cachedir = os.path.dirname(self.cachefile)
+        os.makedirs(cachedir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=cachedir)
+        with os.fdopen(fd, "w") as thisfile:
+            json.dump(self.cache, thisfile)
+        os.replace(tmpname, self.cachefile)
+        self.changed = False
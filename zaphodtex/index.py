@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Persistent index of latexdiff annotations in files.
+
+File: zaphodtex/index.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import concurrent.futures
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+
+
+class AnnotationIndex:
+    """
+    Index of the latexdiff hunks in a set of files.
+
+    Each file is recorded with its modification time, size and inode, so
+    only files that have changed since the last scan are read again. Scans
+    search the memory mapped bytes of a file and do not decode it.
+
+    Scans hold the GIL, so large batches of files are scanned in worker
+    processes, and small ones in this process, where starting workers would
+    cost more than the scans.
+    """
+
+    rxMarker = re.compile(rb"\\DIF(add|del)begin")
+    preambleStart = b"%DIF PREAMBLE EXTENSION ADDED BY LATEXDIFF"
+    preambleEnd = b"%DIF END PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
+    # total size of the files to scan above which worker processes are used
+    processThreshold = 256 * 1024 * 1024
+
+    def __init__(self, indexfile):
+        """Init method.
+
+        :param indexfile: file the index is stored in
+        """
+        self.indexfile = indexfile
+        self.files = {}
+        self.rescanned = 0
+        self.changed = False
+        try:
+            with open(self.indexfile, "r") as thisfile:
+                self.files = json.load(thisfile).get("files", {})
+        except (OSError, ValueError):
+            self.files = {}
+
+    @classmethod
+    def scan(cls, filename):
+        """Get the [kind, byte offset] of each hunk in a file.
+
+        The latexdiff preamble defines the hunk commands, so markers in it
+        are not counted.
+        """
+        hunks = []
+        with open(filename, "rb") as thisfile:
+            if os.fstat(thisfile.fileno()).st_size == 0:
+                return hunks
+            with mmap.mmap(thisfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                preamblestart = data.find(cls.preambleStart)
+                preambleend = -1
+                if preamblestart != -1:
+                    preambleend = data.rfind(cls.preambleEnd)
+                    if preambleend < preamblestart:
+                        preamblestart = -1
+                    else:
+                        preambleend += len(cls.preambleEnd)
+
+                for marker in cls.rxMarker.finditer(data):
+                    if preamblestart <= marker.start() < preambleend:
+                        continue
+                    kind = "addition" if marker.group(1) == b"add" else "deletion"
+                    hunks.append([kind, marker.start()])
+        return hunks
+
+    def is_current(self, filename, stat):
+        """Check if the entry for a file matches its current state."""
+        entry = self.files.get(filename)
+        return (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+            and entry["inode"] == stat.st_ino
+        )
+
+    def update(self, filelist, jobs=None):
+        """Bring the index up to date for the given files.
+
+        Files that changed since they were last scanned are scanned again,
+        in parallel processes if there is enough to scan.
+
+        :param jobs: maximum number of worker processes
+        :returns: dict of file name to its list of hunks
+        """
+        stale = []
+        stats = {}
+        for filename in filelist:
+            key = os.path.abspath(filename)
+            stats[key] = os.stat(filename)
+            if not self.is_current(key, stats[key]):
+                stale.append(key)
+
+        workers = min(jobs or os.cpu_count() or 1, len(stale))
+        size = sum(stats[key].st_size for key in stale)
+        if workers > 1 and size >= self.processThreshold:
+            # workers are spawned: the caller may have threads running, such
+            # as background pdf builds
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                # the largest files first, so that workers finish together
+                stale.sort(key=lambda key: stats[key].st_size, reverse=True)
+                results = list(executor.map(AnnotationIndex.scan, stale))
+        else:
+            results = [self.scan(key) for key in stale]
+
+        for key, hunks in zip(stale, results):
+            self.files[key] = {
+                "mtime": stats[key].st_mtime_ns,
+                "size": stats[key].st_size,
+                "inode": stats[key].st_ino,
+                "hunks": hunks,
+            }
+        self.rescanned += len(stale)
+        if len(stale) > 0:
+            self.changed = True
+
+        return {
+            filename: self.files[os.path.abspath(filename)]["hunks"]
+            for filename in filelist
+        }
+
+    def save(self):
+        """Write the index to disk, if it has changed.
+
+        Entries of files that no longer exist, for example files in removed
+        worktrees, are dropped, so that the index does not keep growing.
+        """
+        existing = {
+            filename: entry
+            for filename, entry in self.files.items()
+            if os.path.exists(filename)
+        }
+        if len(existing) < len(self.files):
+            self.files = existing
+            self.changed = True
+        if not self.changed:
+            return
+        indexdir = os.path.dirname(self.indexfile)
+        os.makedirs(indexdir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=indexdir)
+        with os.fdopen(fd, "w") as thisfile:
+            json.dump({"files": self.files}, thisfile)
+        os.replace(tmpname, self.indexfile)
+        self.changed = False
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Long running server for diff and compile jobs.
+
+File: zaphodtex/server.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import concurrent.futures
+import concurrent.futures.process
+import http.server
+import json
+import multiprocessing
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+def _is_type(value, types):
+    """Check the type of a JSON value, where true and false are not ints."""
+    if isinstance(value, bool) and bool not in types:
+        return False
+    # JSON numbers such as 2 are valid floats
+    if float in types and isinstance(value, int) and not isinstance(value, bool):
+        return True
+    return isinstance(value, types)
+
+
+def option_type(*types):
+    """Get a check that an option is of one of the given types."""
+    names = " or ".join("null" if t is type(None) else t.__name__ for t in types)
+
+    def check(value):
+        if not _is_type(value, types):
+            raise ValueError(f"must be of type {names}")
+
+    return check
+
+
+def option_choice(choices):
+    """Get a check that an option is one of the given values."""
+
+    def check(value):
+        if value not in choices:
+            raise ValueError(f"must be one of: {', '.join(choices)}")
+
+    return check
+
+
+def relative_path(value):
+    """Check that an option is a path that stays in the repository."""
+    option_type(str)(value)
+    path = os.path.normpath(value)
+    if os.path.isabs(path) or path.split(os.sep)[0] == "..":
+        raise ValueError("must be a relative path in the repository")
+
+
+def file_name(value):
+    """Check that an option is a file name without a directory, or null."""
+    if value is None:
+        return
+    option_type(str)(value)
+    if value in ["", ".", ".."] or "/" in value or os.sep in value:
+        raise ValueError("must be a file name")
+
+
+def revision(value):
+    """Check that an option is a revision, and not a git command line option."""
+    option_type(str)(value)
+    if value == "" or value.startswith("-"):
+        raise ValueError("must be a revision")
+
+
+def job_options(defaults, request, checks, fixed=None):
+    """Get the options of a job from its defaults and the options it sets.
+
+    :param defaults: default options
+    :param request: options set for the job
+    :param checks: dict of the options that a job may set to a function that
+        raises ValueError if a value is not valid. All other options keep
+        their defaults, so that jobs can not, for example, write files to
+        other paths.
+    :param fixed: options that are set for every job
+    :returns: options dict
+    :raises ValueError: if the request has options that it may not set, or
+        options with invalid values
+    """
+    unknown = sorted(set(request) - set(checks))
+    if len(unknown) > 0:
+        raise ValueError(f"Options that jobs may not set: {', '.join(unknown)}")
+    for key, value in request.items():
+        try:
+            checks[key](value)
+        except ValueError as E:
+            raise ValueError(f"Option {key} {E}") from None
+
+    options = dict(defaults)
+    options.update(request)
+    options.update(fixed or {})
+    return options
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    JSON over HTTP interface of the server.
+
+    GET /status: server information and job counts
+    GET /jobs: all jobs
+    GET /jobs/ID: one job
+    POST /diff, POST /compile: run a job, with its options as a JSON object.
+        The response is sent when the job has finished, unless "wait" is
+        false, in which case the job is returned straight away and can be
+        polled.
+    """
+
+    server_version = "zaphod"
+
+    def address_string(self):
+        # clients on Unix sockets have no address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        print(f"[Zaphod] {self.address_string()} {format % args}", flush=True)
+
+    def send_json(self, status, body):
+        """Send a JSON response."""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        zaphodserver = self.server.zaphodserver
+        path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+        if path == "/status":
+            self.send_json(200, zaphodserver.status())
+        elif path == "/jobs":
+            self.send_json(200, {"jobs": zaphodserver.list_jobs()})
+        elif path.startswith("/jobs/"):
+            job = zaphodserver.get_job(path[len("/jobs/") :])
+            if job is None:
+                self.send_json(404, {"error": "No such job"})
+            else:
+                self.send_json(200, job)
+        else:
+            self.send_json(404, {"error": f"Unknown path: {path}"})
+
+    def do_POST(self):
+        zaphodserver = self.server.zaphodserver
+        url = urllib.parse.urlsplit(self.path)
+        kind = url.path.strip("/")
+        if kind not in zaphodserver.jobtypes:
+            self.send_json(404, {"error": f"Unknown job type: {kind}"})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+        except ValueError as E:
+            self.send_json(400, {"error": f"Invalid request: {E}"})
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+        wait = request.pop("wait", query.get("wait", ["1"])[0] not in ["0", "false"])
+        try:
+            jobid = zaphodserver.submit(kind, request)
+        except ValueError as E:
+            self.send_json(400, {"error": str(E)})
+            return
+
+        if wait:
+            zaphodserver.wait(jobid)
+            self.send_json(200, zaphodserver.get_job(jobid))
+        else:
+            self.send_json(202, zaphodserver.get_job(jobid))
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    """HTTP server on a TCP port."""
+
+    daemon_threads = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket."""
+
+    daemon_threads = True
+
+
+class ZaphodServer:
+    """
+    Runs diff and compile jobs in a pool of worker processes.
+
+    Workers are started once and run job after job, so Python start up,
+    tool discovery and state that the workers keep, such as the include
+    graph, are not paid for again for each job. Jobs that build the same
+    pdf share latexmk build files, so they are run one at a time.
+    """
+
+    def __init__(self, jobtypes, workers, logdir, info=None):
+        """Init method.
+
+        :param jobtypes: dict of job type name to a dict with "run": function
+            that runs a job in a worker, called with the options, answers to
+            prompts, and a log file, "defaults": default options, that
+            requests may override, "checks": checks of the options that
+            requests may set, as for job_options, "fixed": options that are
+            set for every job, and "jobname": function that gets the pdf
+            jobname from the options
+        :param workers: number of worker processes
+        :param logdir: directory to write job logs to
+        :param info: extra information to include in the status
+        """
+        self.jobtypes = jobtypes
+        self.workers = workers
+        self.logdir = logdir
+        self.info = info or {}
+        self.started = time.time()
+        self.jobs = {}
+        self.events = {}
+        self.buildLocks = {}
+        # jobs only leave the queue when a worker is free for them
+        self.slots = threading.Semaphore(workers)
+        self.lock = threading.Lock()
+        # finished jobs that are kept for polling
+        self.maxJobs = 1000
+        self.pool = self.new_pool()
+        os.makedirs(self.logdir, exist_ok=True)
+
+    def new_pool(self):
+        """Start a pool of worker processes."""
+        # workers are spawned: forking a process with running threads is not
+        # safe
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def replace_broken_pool(self, pool):
+        """Replace the worker pool after a worker died, unless another job has.
+
+        A pool whose worker died fails all of its jobs, so only the jobs that
+        were running in it fail, and later jobs run in the new pool.
+        """
+        with self.lock:
+            if self.pool is pool:
+                self.pool = self.new_pool()
+                print("[Zaphod] A worker died: restarted the workers.", flush=True)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self):
+        """Start all worker processes before the first job arrives."""
+        futures = [self.pool.submit(os.getpid) for i in range(0, self.workers)]
+        for future in futures:
+            future.result()
+
+    def options(self, kind, request):
+        """Get the options for a job from a request.
+
+        :raises ValueError: if the request is not valid
+        """
+        jobtype = self.jobtypes[kind]
+        request = {key: value for key, value in request.items() if key != "pdf"}
+        return job_options(
+            jobtype["defaults"], request, jobtype["checks"], jobtype["fixed"]
+        )
+
+    def submit(self, kind, request):
+        """Queue a job.
+
+        :returns: job id
+        :raises ValueError: if the request is not valid
+        """
+        options = self.options(kind, request)
+        answers = {"pdf": "y" if request.get("pdf", True) else "n"}
+        jobid = uuid.uuid4().hex[:12]
+        job = {
+            "id": jobid,
+            "kind": kind,
+            "status": "queued",
+            "request": request,
+            "returncode": None,
+            "log": os.path.join(self.logdir, f"{jobid}.log"),
+            "submitted": time.time(),
+            "finished": None,
+        }
+        with self.lock:
+            self.jobs[jobid] = job
+            self.events[jobid] = threading.Event()
+            self.forget_old_jobs()
+        threading.Thread(
+            target=self.run_job, args=(job, options, answers), daemon=True
+        ).start()
+        return jobid
+
+    def run_job(self, job, options, answers):
+        """Run a job in a worker and record its result."""
+        jobtype = self.jobtypes[job["kind"]]
+        jobname = jobtype["jobname"](options)
+        with self.lock:
+            buildlock = self.buildLocks.setdefault(jobname, threading.Lock())
+        with buildlock, self.slots:
+            with self.lock:
+                job["status"] = "running"
+            with self.lock:
+                pool = self.pool
+            try:
+                result = pool.submit(
+                    jobtype["run"], options, answers, job["log"]
+                ).result()
+            except concurrent.futures.process.BrokenProcessPool as E:
+                self.replace_broken_pool(pool)
+                result = {"returncode": 1, "error": f"{type(E).__name__}: {E}"}
+            except Exception as E:
+                result = {"returncode": 1, "error": f"{type(E).__name__}: {E}"}
+
+        with self.lock:
+            job.update(result)
+            job["status"] = "done" if job["returncode"] == 0 else "failed"
+            job["finished"] = time.time()
+            self.events[job["id"]].set()
+        print(f"[Zaphod] Job {job['id']} ({job['kind']}): {job['status']}", flush=True)
+
+    def forget_old_jobs(self):
+        """Drop the oldest finished jobs beyond maxJobs. Called with the lock."""
+        finished = [
+            jobid for jobid, job in self.jobs.items() if job["finished"] is not None
+        ]
+        for jobid in finished[: max(0, len(self.jobs) - self.maxJobs)]:
+            del self.jobs[jobid]
+            del self.events[jobid]
+
+    def wait(self, jobid):
+        """Wait for a job to finish."""
+        with self.lock:
+            event = self.events.get(jobid)
+        if event is not None:
+            event.wait()
+
+    def get_job(self, jobid):
+        """Get a copy of a job, or None if there is no such job."""
+        with self.lock:
+            job = self.jobs.get(jobid)
+            return dict(job) if job is not None else None
+
+    def list_jobs(self):
+        """Get copies of all jobs, oldest first."""
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def status(self):
+        """Get information about the server and its jobs."""
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job["status"]] += 1
+        status = {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "workers": self.workers,
+            "jobs": counts,
+        }
+        status.update(self.info)
+        return status
+
+    def serve(self, host="127.0.0.1", port=None, socketpath=None):
+        """Serve requests until interrupted.
+
+        :param host: address to listen on, with port
+        :param port: TCP port to listen on
+        :param socketpath: Unix socket to listen on, instead of a port
+        """
+        if socketpath is not None:
+            # left behind by a server that did not stop cleanly
+            if os.path.exists(socketpath):
+                os.remove(socketpath)
+            # the socket is only ever accessible to this user
+            umask = os.umask(0o077)
+            try:
+                httpd = _UnixHTTPServer(socketpath, _RequestHandler)
+            finally:
+                os.umask(umask)
+            address = socketpath
+        else:
+            httpd = _HTTPServer((host, port), _RequestHandler)
+            address = f"http://{host}:{httpd.server_address[1]}"
+        httpd.zaphodserver = self
+
+        self.warm_up()
+        print(f"[Zaphod] Serving on {address} with {self.workers} workers.", flush=True)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print("[Zaphod] Shutting down.", flush=True)
+            httpd.server_close()
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            if socketpath is not None and os.path.exists(socketpath):
+                os.remove(socketpath)
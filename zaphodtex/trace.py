@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Timing traces of Zaphod runs.
+
+File: zaphodtex/trace.py
+
+Copyright 2025 Ankur Sinha
+Author: Ankur Sinha <sanjay DOT ankur AT gmail DOT com>
+"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+
+
+class Span:
+    """A timed part of a run, used as a context manager."""
+
+    __slots__ = ["tracer", "name", "category", "args", "start"]
+
+    def __init__(self, tracer, name, category, args):
+        """Init method."""
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def set(self, **args):
+        """Add arguments, such as an exit code or byte counts, to the span."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args.setdefault("error", exc_type.__name__)
+        self.tracer.record(self, end)
+        return False
+
+
+class _NullSpan:
+    """Span that records nothing, used when tracing is disabled."""
+
+    __slots__ = []
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Records spans of phases and subprocesses in Chrome trace event format.
+
+    The trace file can be opened in chrome://tracing or https://ui.perfetto.dev.
+    When no trace file is given, spans are not recorded and subprocesses are
+    run directly.
+    """
+
+    def __init__(self, tracefile=None):
+        """Init method.
+
+        :param tracefile: file to write the trace to, None to disable tracing
+        """
+        # runs may change directory, for example into a worktree
+        self.tracefile = os.path.abspath(tracefile) if tracefile else None
+        self.enabled = self.tracefile is not None
+        self.events = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def span(self, name, category="phase", **args):
+        """Get a span to time a block with.
+
+        :param name: name of the phase or subprocess
+        :param category: "phase", "file" or "subprocess"
+        :param args: extra information to record, for example the file
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, span, end):
+        """Store a finished span."""
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": (span.start - self.origin) * 1e6,
+            "dur": (end - span.start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": span.args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def command_span(self, command, kwargs):
+        """Get a span for a subprocess."""
+        if not self.enabled:
+            return NULL_SPAN
+        # "git checkout", "latexmk"
+        name = " ".join(command[:2]) if command[0] == "git" else command[0]
+        span = self.span(name, "subprocess", command=" ".join(command))
+        if kwargs.get("input") is not None:
+            span.set(bytes_in=len(kwargs["input"]))
+        return span
+
+    def call(self, command, **kwargs):
+        """Traced subprocess.call."""
+        if not self.enabled:
+            return subprocess.call(command, **kwargs)
+        with self.command_span(command, kwargs) as span:
+            returncode = subprocess.call(command, **kwargs)
+            span.set(returncode=returncode)
+        return returncode
+
+    def check_call(self, command, **kwargs):
+        """Traced subprocess.check_call."""
+        if not self.enabled:
+            return subprocess.check_call(command, **kwargs)
+        with self.command_span(command, kwargs) as span:
+            try:
+                subprocess.check_call(command, **kwargs)
+            except subprocess.CalledProcessError as E:
+                span.set(returncode=E.returncode)
+                raise
+            span.set(returncode=0)
+        return 0
+
+    def check_output(self, command, **kwargs):
+        """Traced subprocess.check_output."""
+        if not self.enabled:
+            return subprocess.check_output(command, **kwargs)
+        with self.command_span(command, kwargs) as span:
+            try:
+                output = subprocess.check_output(command, **kwargs)
+            except subprocess.CalledProcessError as E:
+                span.set(returncode=E.returncode)
+                raise
+            span.set(returncode=0, bytes_out=len(output))
+        return output
+
+    def summary(self, count=10):
+        """Get the slowest stages and files.
+
+        :param count: number of entries in each list
+        :returns: list of (name, calls, total seconds, max seconds) of the
+            stages that took longest in total, and list of (name, file,
+            seconds) of the slowest spans of single files
+        """
+        stages = {}
+        files = []
+        for event in self.events:
+            calls, total, longest = stages.get(event["name"], (0, 0.0, 0.0))
+            stages[event["name"]] = (
+                calls + 1,
+                total + event["dur"] / 1e6,
+                max(longest, event["dur"] / 1e6),
+            )
+            if "file" in event["args"]:
+                files.append((event["name"], event["args"]["file"], event["dur"] / 1e6))
+
+        stages = sorted(
+            [(name,) + values for name, values in stages.items()],
+            key=lambda stage: stage[2],
+            reverse=True,
+        )
+        files = sorted(files, key=lambda entry: entry[2], reverse=True)
+        return stages[:count], files[:count]
+
+    def write(self):
+        """Write the trace file and print a summary."""
+        if not self.enabled:
+            return
+        with open(self.tracefile, "w") as thisfile:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, thisfile)
+
+        stages, files = self.summary()
+        print(f"[Zaphod] Trace written to {self.tracefile}")
+        print("[Zaphod] Slowest stages:")
+        print(f"    {'stage':24} {'calls':>6} {'total (s)':>10} {'max (s)':>10}")
+        for name, calls, total, longest in stages:
+            print(f"    {name:24} {calls:6} {total:10.3f} {longest:10.3f}")
+        if len(files) > 0:
+            print("[Zaphod] Slowest files:")
+            print(f"    {'stage':24} {'time (s)':>10} file")
+            for name, filename, elapsed in files:
+                print(f"    {name:24} {elapsed:10.3f} {filename}")
@@ -22,17 +22,65 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import fnmatch
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import tempfile
 import textwrap
-
-from zaphod import __version__
+import threading
+import time
+import traceback
+import uuid
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from zaphodtex import __version__
+from zaphodtex.cache import (
+    DiffCache,
+    PdfCache,
+    default_cache_dir,
+    git_blob_hash,
+    recorded_inputs,
+    recorded_outputs,
+)
+from zaphodtex.diffengine import (
+    ENGINES,
+    DiffDeclined,
+    LatexdiffEngine,
+    NativeEngine,
+    SectionEngine,
+)
+from zaphodtex.gitbackend import BACKENDS, GitBackend, GitError
+from zaphodtex.includes import IncludeGraph
+from zaphodtex.index import AnnotationIndex
+from zaphodtex.server import (
+    ZaphodServer,
+    file_name,
+    job_options,
+    option_choice,
+    option_type,
+    relative_path,
+    revision,
+)
+from zaphodtex.trace import Tracer
+
+Hunk = collections.namedtuple("Hunk", ["kind", "start", "end", "payload"])
 
 
 class _HelpAction(argparse._HelpAction):
@@ -58,6 +106,163 @@ class _HelpAction(argparse._HelpAction):
                 print(subparser.format_help())
 
 
+@contextlib.contextmanager
+def _redirect_output(logfile):
+    """Send all output of this process, and of its subprocesses, to logfile."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(logfile, "w") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+# state that a worker process keeps between the jobs that it runs
+_workerState: dict = {}
+
+
+def _run_diff_job(options, answers, logfile):
+    """Run a diff in a worker process.
+
+    :param options: options dict, as created by the argument parser
+    :param answers: answers to prompts
+    :param logfile: file that all output is written to
+    :returns: dict with the exit code, annotated branch, pdf, and log file
+    """
+    result = {"returncode": 0, "branch": None, "pdf": None, "log": logfile}
+    with _redirect_output(logfile):
+        # worker processes run several jobs: drop handlers of earlier ones
+        logging.getLogger("zaphod").handlers.clear()
+        runner_instance = Zaphod()
+        runner_instance.optionsDict = options
+        runner_instance.answers.update(answers)
+        # parsed includes are reused by later jobs in the same repository
+        graphkey = ("includegraph", os.getcwd())
+        runner_instance.includegraph = _workerState.get(graphkey)
+        try:
+            runner_instance.use_git_backend()
+            runner_instance.diff(None)
+        except SystemExit as E:
+            result["returncode"] = E.code if isinstance(E.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            result["returncode"] = 1
+        _workerState[graphkey] = runner_instance.includegraph
+
+        result["branch"] = runner_instance.annotatedBranch
+        pdf = os.path.join(
+            runner_instance.get_zaphod_dir(),
+            "pdf",
+            runner_instance.finalBranch + ".pdf",
+        )
+        if os.path.isfile(pdf):
+            result["pdf"] = pdf
+        runner_instance.git.close()
+        runner_instance.logger.info(runner_instance.git.report())
+        result["git_subprocesses"] = runner_instance.git.spawned
+    return result
+
+
+def _diff_job_checks():
+    """Get the checks of the options that diff jobs sent to the server may set.
+
+    Options that write to or read from other paths, such as --stats and
+    --cache-dir, are left out, and latexdiff options are limited to those
+    that only change the markup.
+    """
+    flag = option_type(bool)
+    return {
+        "rev1": revision,
+        "rev2": revision,
+        "main": relative_path,
+        "subdir": relative_path,
+        "latexdiffopts": LatexdiffEngine.check_options,
+        "engine": option_choice(sorted(ENGINES)),
+        "split_sections": option_type(float, type(None)),
+        "jobs": option_type(int, type(None)),
+        "citations": flag,
+        "all_files": flag,
+        "follow_includes": flag,
+        "no_cache": flag,
+        "incremental": flag,
+        "clean_build": flag,
+        "changed_only": flag,
+        "no_pdf_cache": flag,
+    }
+
+
+def _compile_job_checks():
+    """Get the checks of the options that compile jobs may set."""
+    flag = option_type(bool)
+    return {
+        "rev": revision,
+        "main": relative_path,
+        "subdir": relative_path,
+        "jobname": file_name,
+        "citations": flag,
+        "incremental": flag,
+        "clean_build": flag,
+        "no_pdf_cache": flag,
+    }
+
+
+def _build_dirname(options, filename):
+    """Get the directory in .git/zaphod/build that a jobname is built in.
+
+    Builds with --changed-only reuse the .aux files of included units from
+    earlier builds of the same main file, also of other revision pairs, so
+    they share one directory for each main file instead of each jobname.
+    """
+    if not options.get("changed_only"):
+        return filename
+    mainfile = os.path.normpath(os.path.join(options["subdir"], options["main"]))
+    return "units-" + os.path.splitext(mainfile)[0].replace(os.sep, "-")
+
+
+def _compile_jobname(options):
+    """Get the jobname of the pdf of a compile job."""
+    if options.get("jobname"):
+        return options["jobname"]
+    mainfile = os.path.normpath(os.path.join(options["subdir"], options["main"]))
+    return "zaphod-compile-" + os.path.splitext(mainfile)[0].replace(os.sep, "-")
+
+
+def _run_compile_job(options, answers, logfile):
+    """Build the pdf of a revision in a worker process.
+
+    :param options: options dict, with the revision to build in "rev"
+    :param answers: answers to prompts, not used
+    :param logfile: file that all output is written to
+    :returns: dict with the exit code, pdf, and log file
+    """
+    result = {"returncode": 0, "pdf": None, "log": logfile}
+    with _redirect_output(logfile):
+        logging.getLogger("zaphod").handlers.clear()
+        runner_instance = Zaphod()
+        runner_instance.optionsDict = options
+        try:
+            runner_instance.use_git_backend()
+            result["pdf"] = runner_instance.build_revision()
+        except SystemExit as E:
+            result["returncode"] = E.code if isinstance(E.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            result["returncode"] = 1
+        runner_instance.git.close()
+        runner_instance.logger.info(runner_instance.git.report())
+        result["git_subprocesses"] = runner_instance.git.spawned
+    return result
+
+
 class Zaphod:
     """Main application class"""
 
@@ -104,18 +309,44 @@ class Zaphod:
         self.rev1Branch = self.timenow + self.branchSpec + "rev1"
         self.rev2Branch = self.timenow + self.branchSpec + "rev2"
         self.finalBranch = self.timenow + self.branchSpec + "annotated"
+        # set once this run has created the annotated branch
+        self.annotatedBranch = None
 
         self.filelist = []
         self.rev1filelist = []
         self.rev2filelist = []
+        # files that do not exist in rev2, diffed against empty files
+        self.rev2missing = set()
         self.modifiedfiles = []
+        self.scratchdir = None
+        # directory that annotated files are written to, instead of in place
+        self.outputdir = None
+        self.diffcache = None
+        self.diffengine = None
+        self.annotationindex = None
+        self.includegraph = None
+        # paths of the tools found by check_setup
+        self.tools = {}
+        self.worktree = None
+        self.originaldir = None
+        self.decisionRules = []
+        self.decisionCounts = {"y": 0, "n": 0, "asked": 0}
+        # pre-set answers to prompts, used instead of asking the user
+        self.answers = {}
+        # records nothing unless a trace file is given
+        self.tracer = Tracer()
+        # runs all git operations
+        self.git = GitBackend(self.tracer)
+        # files written by pdf builds in the working tree, committed with
+        # the sources
+        self.builtfiles = []
+
+        # background pdf builds
+        self.buildLock = threading.Lock()
+        self.buildGeneration = 0
+        self.buildProcess = None
+        self.buildThread = None
 
-        self.gitResetCommand = "git reset HEAD --hard".split()
-        self.gitCheckoutCommand = "git checkout".split()
-        self.gitAddCommand = "git add .".split()
-        self.gitCommitCommand = "git commit -m".split()
-        self.gitBranchCommand = "git branch".split()
-        self.gitBranchDeleteCommand = "git branch -D".split()
         self.latexmkCleanCommand = "latexmk -C".split()
         self.latexmkCommand = (
             "latexmk -pdf -recorder".split()
@@ -126,22 +357,39 @@ class Zaphod:
         self.bibFlag = ["-bibtex"]
         self.nobibFlag = ["-nobibtex"]
 
-        # regular expressions for revision
-        self.rxDelbegin = re.compile(r"\\DIFdelbegin\s*")
-        self.rxDelend = re.compile(r"\\DIFdelend\s*")
+        # regular expressions for revision, which works on the bytes of
+        # memory mapped files
+        self.rxDelbegin = re.compile(rb"\\DIFdelbegin\s*")
+        self.rxDelend = re.compile(rb"\\DIFdelend\s*")
 
-        self.rxAddbegin = re.compile(r"\\DIFaddbegin\s*")
-        self.rxAddend = re.compile(r"\\DIFaddend\s*")
+        self.rxAddbegin = re.compile(rb"\\DIFaddbegin\s*")
+        self.rxAddend = re.compile(rb"\\DIFaddend\s*")
 
         self.rPreamble = (
             r"%DIF PREAMBLE EXTENSION ADDED BY LATEXDIFF.*"
             + r"%DIF END PREAMBLE EXTENSION ADDED BY LATEXDIFF\n"
         )
-        self.rxPreamble = re.compile(self.rPreamble, flags=re.DOTALL)
+        self.rxPreamble = re.compile(self.rPreamble.encode("ascii"), flags=re.DOTALL)
+        # one pattern for everything that starts a hunk, so that the text is
+        # scanned only once
+        self.rxHunk = re.compile(
+            rb"(?P<preamble>"
+            + self.rPreamble.encode("ascii")
+            + rb")|(?P<deletion>\\DIFdelbegin\s*)|(?P<addition>\\DIFaddbegin\s*)",
+            flags=re.DOTALL,
+        )
+        # headings that change statistics are grouped by
+        self.rxHeading = re.compile(
+            rb"\\(?:part|chapter|section|subsection|subsubsection)\*?"
+            + rb"\s*(?:\[[^\]]*\])?\s*\{[^{}\n]*\}?"
+        )
+        self.rxBrace = re.compile(r"\\.|[{}]", flags=re.DOTALL)
         self.rxStray = (
             r"(\\DIFaddbegin\s*)|(\\DIFaddend\s*)"
             + r"(\\DIFdelbegin\s*)|(\\DIFdelend\s*)"
         )
+        # unchanged text is copied to revised files in blocks of this size
+        self.copyBlockSize = 1024 * 1024
 
         # set up a logger
         self.logger = logging.getLogger("zaphod")
@@ -157,35 +405,242 @@ class Zaphod:
 
     def diff(self, args):
         """Do the diff part."""
-        # Get all latex files in rev1
-        command = (
-            self.gitCheckoutCommand
-            + (" -b " + self.rev1Branch).split()
-            + [self.optionsDict["rev1"]]
+        if self.optionsDict.get("series"):
+            self.diff_series()
+            return
+        if self.optionsDict.get("stats"):
+            self.diff_stats()
+            return
+
+        if self.optionsDict["worktree"]:
+            # other runs may be creating branches at the same time
+            token = uuid.uuid4().hex[:8]
+            prefix = self.timenow + self.branchSpec + token
+            self.rev1Branch = prefix + "-rev1"
+            self.rev2Branch = prefix + "-rev2"
+            self.finalBranch = prefix + "-annotated"
+
+        try:
+            self.run_diff()
+        finally:
+            self.remove_worktree()
+
+    def run_diff(self):
+        """Generate the annotated sources, pdf, and branches."""
+        with self.tracer.span("prepare revisions"):
+            try:
+                if self.optionsDict.get("prepared"):
+                    self.use_prepared_revisions()
+                elif self.optionsDict["no_checkout"] or self.optionsDict["worktree"]:
+                    self.read_revisions()
+                else:
+                    self.checkout_revisions()
+            except subprocess.CalledProcessError as E:
+                # nothing may be committed unless the annotated branch is
+                # checked out
+                self.logger.error(
+                    f"{' '.join(E.cmd)} failed: not saving changes. Exiting!"
+                )
+                sys.exit(-10)
+
+        self.run_diff_engine()
+
+        self.generate_pdf(
+            "zaphod-diff-" + self.optionsDict["rev1"] + "-" + self.optionsDict["rev2"]
         )
-        p = subprocess.Popen(command)
-        p.wait()
+
+        with self.tracer.span("commit"):
+            # only the files that this run wrote, or removed
+            self.git.stage(self.filelist + self.builtfiles)
+            self.git.commit(
+                "Save annotated changes between "
+                + self.optionsDict["rev1"]
+                + " and "
+                + self.optionsDict["rev2"]
+            )
+
+        self.zprint("The following branches have been created:")
+        self.zprint(self.rev1Branch + ": Revision 1.")
+        self.zprint(self.rev2Branch + ": Revision 2.")
+        self.zprint(self.finalBranch + ": Branch with annotated versions of sources")
+
+    def run_diff_engine(self):
+        """Set up the diff engine and cache, and annotate all files."""
+        self.diffengine = ENGINES[self.optionsDict["engine"]](
+            self.optionsDict["latexdiffopts"]
+        )
+        if self.optionsDict["split_sections"]:
+            self.diffengine = SectionEngine(
+                self.diffengine,
+                self.optionsDict["split_sections"] * 1024 * 1024,
+                self.optionsDict["jobs"] or os.cpu_count() or 1,
+            )
+        if not self.optionsDict["no_cache"]:
+            self.diffcache = DiffCache(
+                self.optionsDict["cache_dir"],
+                self.optionsDict["cache_size"] * 1024 * 1024,
+            )
+
+        with self.tracer.span("generate diffs", files=len(self.filelist)):
+            self.generate_diffs()
+
+        if self.diffcache:
+            self.zprint(
+                f"Diff cache: {self.diffcache.hits} hits, "
+                + f"{self.diffcache.misses} misses."
+            )
+            self.diffcache.save_stats()
+            self.diffcache.prune()
+
+    def diff_stats(self):
+        """Report change statistics between the revisions as JSON.
+
+        The annotated files are written to a scratch directory: no branches
+        are created, nothing is checked out or committed, and no pdf is
+        built.
+        """
+        output = self.optionsDict["stats"]
+        # keep stdout for the JSON report
+        with (
+            contextlib.redirect_stdout(sys.stderr)
+            if output == "-"
+            else contextlib.nullcontext()
+        ):
+            with self.tracer.span("prepare revisions"):
+                self.read_revisions(branches=False)
+            self.outputdir = tempfile.mkdtemp(prefix="zaphod-stats-")
+            try:
+                self.run_diff_engine()
+                with self.tracer.span("change stats"):
+                    stats = self.change_stats(
+                        self.modifiedfiles,
+                        [
+                            os.path.join(self.outputdir, filename)
+                            for filename in self.modifiedfiles
+                        ],
+                    )
+            finally:
+                shutil.rmtree(self.outputdir, ignore_errors=True)
+                self.outputdir = None
+
+        stats.update(
+            {"rev1": self.optionsDict["rev1"], "rev2": self.optionsDict["rev2"]}
+        )
+        self.write_stats(stats, output)
+
+    def stats(self, args):
+        """Report change statistics of the annotated files as JSON."""
+        output = self.optionsDict["output"]
+        with (
+            contextlib.redirect_stdout(sys.stderr)
+            if output == "-"
+            else contextlib.nullcontext()
+        ):
+            filelist = self.get_modified_latex_files()
+            with self.tracer.span("change stats"):
+                stats = self.change_stats(filelist)
+        self.write_stats(stats, output)
+
+    def change_stats(self, filelist, paths=None):
+        """Count the additions and deletions in annotated files.
+
+        Hunks are found as in revise. For each file, and for each section
+        of a file that has changes, the number of added and deleted hunks,
+        words and bytes are counted. Hunks before the first heading are in
+        a section that is null.
+
+        :param filelist: names of the files to report
+        :param paths: paths to read the files from, default: filelist
+        :returns: dict with the "total" counts, and the counts of each file
+            in "files"
+        """
+        total = self.empty_stats()
+        files = {}
+        for filename, path in zip(filelist, paths or filelist):
+            filestats = self.empty_stats()
+            sections = {}
+            with open(path, "rb") as thisfile, self.map_file(thisfile) as filedata:
+                headings = [
+                    (match.start(), match.group().decode("utf-8", errors="replace"))
+                    for match in self.rxHeading.finditer(filedata)
+                ]
+                starts = [start for start, heading in headings]
+                for hunk in self.iter_hunks(filedata):
+                    if hunk.kind != "addition" and hunk.kind != "deletion":
+                        continue
+                    i = bisect.bisect_right(starts, hunk.start) - 1
+                    heading = headings[i][1] if i >= 0 else None
+                    if heading not in sections:
+                        sections[heading] = self.empty_stats()
+                    for counts in [total, filestats, sections[heading]]:
+                        self.count_hunk(counts, hunk)
+
+            if filestats["additions"] + filestats["deletions"] == 0:
+                continue
+            filestats["sections"] = [
+                dict(section=heading, **counts) for heading, counts in sections.items()
+            ]
+            files[os.path.normpath(filename)] = filestats
+        total["files"] = len(files)
+        return {"total": total, "files": files}
+
+    def empty_stats(self):
+        """Get a dict of zero change counts."""
+        return {
+            "additions": 0,
+            "deletions": 0,
+            "words_added": 0,
+            "words_deleted": 0,
+            "bytes_added": 0,
+            "bytes_deleted": 0,
+        }
+
+    def count_hunk(self, counts, hunk):
+        """Add an addition or deletion hunk to a dict of change counts."""
+        if hunk.kind == "addition":
+            counts["additions"] += 1
+            suffix = "added"
+        else:
+            counts["deletions"] += 1
+            suffix = "deleted"
+        counts["words_" + suffix] += len(hunk.payload.split())
+        counts["bytes_" + suffix] += len(
+            hunk.payload.encode("utf-8", errors="surrogateescape")
+        )
+
+    def write_stats(self, stats, output):
+        """Write change statistics as JSON to a file, or to stdout for -."""
+        if output == "-":
+            json.dump(stats, sys.stdout, indent=2)
+            print()
+            return
+        with open(output, "w") as thisfile:
+            json.dump(stats, thisfile, indent=2)
+        self.zprint(f"Change statistics written to {output}")
+
+    def checkout_revisions(self):
+        """Check out both revisions and rename files for latexdiff."""
+        # resolved first, since revisions such as HEAD~1 change meaning once
+        # a revision is checked out
+        rev1 = self.rev_parse(self.optionsDict["rev1"])
+        rev2 = self.rev_parse(self.optionsDict["rev2"])
+
+        # Get all latex files in rev1
+        self.git.checkout(rev1, self.rev1Branch)
         self.zprint("Generating full file list.")
         self.filelist += self.get_latex_files()
 
         # Get all latex files in rev2
-        command = (
-            self.gitCheckoutCommand
-            + (" -b " + self.rev2Branch).split()
-            + [self.optionsDict["rev2"]]
-        )
-        p = subprocess.Popen(command)
-        p.wait()
+        self.git.checkout(rev2, self.rev2Branch)
         self.filelist += self.get_latex_files()
-        # remove duplicates
-        self.filelist = list(set(self.filelist))
+        # remove duplicates, sorted so that runs are reproducible
+        self.filelist = sorted(set(self.filelist))
         self.zprint(f"File list generated:\n{self.filelist}")
+        self.filter_unchanged_files(rev1, rev2)
 
         # Now that we have a complete list, we get to work
         self.zprint(f"Checking out revision 1: {self.optionsDict['rev1']}")
-        command = self.gitCheckoutCommand + [self.rev1Branch]
-        p = subprocess.Popen(command)
-        p.wait()
+        self.git.checkout(self.rev1Branch)
         self.rev1filelist = self.generate_rev_filenames(self.optionsDict["rev1"])
 
         # Rename files
@@ -203,76 +658,614 @@ class Zaphod:
 
         # Check out revision 2
         self.zprint(f"Checking out revision 2: {self.optionsDict['rev2']}")
-        command = self.gitCheckoutCommand + [self.rev2Branch]
-        p = subprocess.Popen(command)
-        p.wait()
+        self.git.checkout(self.rev2Branch)
 
         # Reset the state so that the files we deleted earlier are back
-        subprocess.call(self.gitResetCommand)
+        self.git.reset_hard()
 
         self.zprint("Checking out branch to save changes.")
-        command = (
-            self.gitCheckoutCommand
-            + (" -b " + self.finalBranch).split()
-            + [self.rev2Branch]
-        )
-        subprocess.call(command)
+        self.git.checkout(self.rev2Branch, self.finalBranch)
+        self.annotatedBranch = self.finalBranch
 
         self.rev2filelist = self.generate_rev_filenames(self.optionsDict["rev2"])
         # Rename files
         for i in range(0, len(self.filelist)):
             if not os.path.isfile(self.filelist[i]):
+                self.rev2missing.add(self.filelist[i])
                 open(self.filelist[i], "a").close()
             os.rename(self.filelist[i], self.rev2filelist[i])
 
-        # Generate diffs
-        for i in range(0, len(self.filelist)):
-            command = (
-                ["latexdiff"]
-                + self.optionsDict["latexdiffopts"].split()
-                + [self.rev1filelist[i], self.rev2filelist[i]]
-            )
-            # self.zprint(command)
-            changedtext = None
-            changedtext = subprocess.check_output(command)
-            if changedtext is None:
-                self.logger.error(
-                    "Something went wrong "
-                    + f"- not annotating file: {self.filelist[i]}\n",
-                    file=sys.stderr,
+    def read_revisions(self, branches=True):
+        """Write both revisions to a scratch directory from the git objects.
+
+        Only the final annotated branch is checked out in the working tree.
+
+        :param branches: create the revision branches and check out the
+            annotated branch
+        """
+        rev1 = self.rev_parse(self.optionsDict["rev1"])
+        rev2 = self.rev_parse(self.optionsDict["rev2"])
+
+        self.zprint("Generating full file list.")
+        self.filelist = sorted(
+            set(self.get_rev_latex_files(rev1) + self.get_rev_latex_files(rev2))
+        )
+        if not len(self.filelist) > 0:
+            print("No tex files found in this directory", file=sys.stderr)
+            sys.exit(-1)
+        self.zprint(f"File list generated:\n{self.filelist}")
+        self.filter_unchanged_files(rev1, rev2)
+
+        self.scratchdir = tempfile.mkdtemp(prefix="zaphod-")
+        self.rev1filelist = []
+        self.rev2filelist = []
+        for filename in self.filelist:
+            for rev, revdir, revfilelist in [
+                (rev1, "rev1", self.rev1filelist),
+                (rev2, "rev2", self.rev2filelist),
+            ]:
+                revname = os.path.join(self.scratchdir, revdir, filename)
+                os.makedirs(os.path.dirname(revname), exist_ok=True)
+                contents = self.git.read_file(rev, filename)
+                # a file missing in this revision is diffed as empty
+                with open(revname, "wb") as revfile:
+                    if contents is not None:
+                        revfile.write(contents)
+                revfilelist.append(revname)
+
+        if branches:
+            self.create_branches(rev1, rev2)
+
+    def use_prepared_revisions(self):
+        """Use revision files that have already been written for latexdiff.
+
+        This is used by series runs, where all revisions are written once
+        to a shared directory.
+        """
+        prepared = self.optionsDict["prepared"]
+        self.filelist = prepared["filelist"]
+        self.rev1filelist = prepared["rev1filelist"]
+        self.rev2filelist = prepared["rev2filelist"]
+        self.zprint(f"File list:\n{self.filelist}")
+        self.create_branches(self.optionsDict["rev1"], self.optionsDict["rev2"])
+
+    def create_branches(self, rev1, rev2):
+        """Create the revision branches and check out the branch for changes."""
+        self.git.create_branch(self.rev1Branch, rev1)
+        self.git.create_branch(self.rev2Branch, rev2)
+
+        if self.optionsDict["worktree"]:
+            self.add_worktree(self.rev2Branch, self.finalBranch)
+        else:
+            self.zprint("Checking out branch to save changes.")
+            self.git.checkout(self.rev2Branch, self.finalBranch)
+        self.annotatedBranch = self.finalBranch
+
+    def add_worktree(self, start, branch=None):
+        """Check out a revision in a new temporary worktree.
+
+        Zaphod continues in the same subdirectory of the worktree, so the
+        user's working tree is not touched.
+
+        :param start: revision to check out
+        :param branch: new branch to create at start, for example the branch
+            to save changes in, or None to check out start detached
+        """
+        prefix = self.git.show_prefix()
+
+        self.originaldir = os.getcwd()
+        self.worktree = tempfile.mkdtemp(prefix="zaphod-worktree-")
+        if branch is not None:
+            self.zprint(f"Checking out branch to save changes in {self.worktree}.")
+        else:
+            self.zprint(f"Checking out {start} in {self.worktree}.")
+        self.git.worktree_add(self.worktree, start, branch)
+        os.chdir(os.path.join(self.worktree, prefix))
+
+    def remove_worktree(self):
+        """Remove the temporary worktree, keeping its branch."""
+        if self.worktree is None:
+            return
+        os.chdir(self.originaldir)
+        self.git.worktree_remove(self.worktree)
+        self.worktree = None
+
+    def build_revision(self):
+        """Build the pdf of a revision in a temporary worktree.
+
+        :returns: the pdf, which is kept in the Zaphod directory
+        """
+        rev = self.rev_parse(self.optionsDict["rev"])
+        jobname = _compile_jobname(self.optionsDict)
+        # the name that build_pdf saves pdfs built in worktrees under
+        self.finalBranch = f"{jobname}-{rev[:10]}"
+        try:
+            self.add_worktree(rev)
+            if self.build_pdf(jobname) != 0:
+                sys.exit(-1)
+        finally:
+            self.remove_worktree()
+        return os.path.join(self.get_zaphod_dir(), "pdf", self.finalBranch + ".pdf")
+
+    def serve(self, args):
+        """Run diff and compile jobs sent over HTTP until interrupted."""
+        workers = self.optionsDict["jobs"] or os.cpu_count() or 1
+
+        diffdefaults = vars(self.parser.parse_args(["diff"]))
+        for key in ["func", "trace", "series", "worktree"]:
+            diffdefaults.pop(key)
+        diffdefaults["jobs"] = max(1, (os.cpu_count() or 1) // workers)
+        diffdefaults["git_backend"] = self.optionsDict["git_backend"]
+        compiledefaults = {
+            "rev": "HEAD",
+            "main": "main.tex",
+            "subdir": ".",
+            "jobname": None,
+            "citations": True,
+            "incremental": True,
+            "clean_build": False,
+            "no_pdf_cache": False,
+            "cache_dir": default_cache_dir(),
+            "pdf_cache_size": 1024,
+            "git_backend": self.optionsDict["git_backend"],
+        }
+        jobtypes = {
+            "diff": {
+                "run": _run_diff_job,
+                "defaults": diffdefaults,
+                "checks": _diff_job_checks(),
+                # each job in its own worktree, so that jobs can run at once
+                "fixed": {"worktree": True, "series": None},
+                # as in run_diff, jobs that share build files run one at a
+                # time
+                "jobname": lambda options: _build_dirname(
+                    options, "zaphod-diff-" + options["rev1"] + "-" + options["rev2"]
+                ),
+            },
+            "compile": {
+                "run": _run_compile_job,
+                "defaults": compiledefaults,
+                "checks": _compile_job_checks(),
+                "fixed": {},
+                "jobname": _compile_jobname,
+            },
+        }
+
+        server = ZaphodServer(
+            jobtypes,
+            workers,
+            os.path.join(self.get_zaphod_dir(), "serve"),
+            {"version": __version__, "cwd": os.getcwd(), "tools": self.tools},
+        )
+        # stop cleanly when the service manager stops the server
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        server.serve(
+            self.optionsDict["host"],
+            self.optionsDict["port"],
+            self.optionsDict["socket"],
+        )
+
+    def batch(self, args):
+        """Run the diffs listed in a manifest, without any prompts.
+
+        The manifest has a list of "jobs", each with the options of the diff
+        subcommand that server diff jobs take, such as "subdir", "main",
+        "rev1" and "rev2", and "stats" and the cache options, given directly
+        or in an "options" mapping, an optional "name", and
+        "pdf" (true/false). Options in the top level "defaults" mapping apply
+        to all jobs. Jobs run in parallel worker processes, each in its own
+        worktree. Jobs whose subdirectory has no changed .tex files are
+        skipped.
+        """
+        manifest = self.load_data_file(self.optionsDict["manifest"], "manifest")
+        defaults = vars(self.parser.parse_args(["diff"]))
+        for key in ["func", "trace", "series", "worktree"]:
+            defaults.pop(key)
+        defaults["git_backend"] = self.optionsDict["git_backend"]
+        # manifests are written by the user, so they may also set paths
+        checks = _diff_job_checks()
+        checks.update(
+            {
+                "latexdiffopts": option_type(str),
+                "stats": option_type(str, type(None)),
+                "cache_dir": option_type(str),
+                "cache_size": option_type(int),
+                "pdf_cache_size": option_type(int),
+            }
+        )
+
+        entries = []
+        for i, entry in enumerate(manifest.get("jobs", [])):
+            request = dict(manifest.get("defaults", {}))
+            if not isinstance(entry, dict):
+                self.logger.error(f"Job {i + 1} in the manifest is not a mapping.")
+                sys.exit(-7)
+            request.update(
+                {key: value for key, value in entry.items() if key != "options"}
+            )
+            request.update(entry.get("options", {}))
+            name = request.pop("name", None)
+            pdf = request.pop("pdf", True)
+            try:
+                options = job_options(defaults, request, checks, {"worktree": True})
+            except ValueError as E:
+                self.logger.error(f"Job {i + 1} in the manifest: {E}")
+                sys.exit(-7)
+            if name is None:
+                name = os.path.normpath(
+                    os.path.join(options["subdir"], options["main"])
+                )
+            entries.append(
+                {"name": name, "options": options, "pdf": "y" if pdf else "n"}
+            )
+        if len(entries) == 0:
+            self.zprint("No jobs in manifest. Nothing to do.")
+            return
+
+        batchid = self.timenow + "-" + uuid.uuid4().hex[:8]
+        batchdir = os.path.join(self.get_zaphod_dir(), "batch", batchid)
+        os.makedirs(batchdir, exist_ok=True)
+        jobs = self.optionsDict["jobs"] or os.cpu_count() or 1
+        workers = min(jobs, len(entries))
+
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = []
+            for i, entry in enumerate(entries):
+                options = entry["options"]
+                result = {
+                    "index": i + 1,
+                    "name": entry["name"],
+                    "subdir": options["subdir"],
+                    "main": options["main"],
+                    "rev1": options["rev1"],
+                    "rev2": options["rev2"],
+                }
+                results.append(result)
+                if not options["all_files"]:
+                    try:
+                        changes = self.get_changed_latex_files(
+                            options["rev1"], options["rev2"], options["subdir"]
+                        )
+                    except subprocess.CalledProcessError:
+                        # the job reports what is wrong with its revisions
+                        changes = None
+                    if changes is not None and len(changes) == 0:
+                        result.update({"status": "skipped", "returncode": None})
+                        futures.append(None)
+                        continue
+
+                if options["jobs"] is None:
+                    options["jobs"] = max(1, jobs // workers)
+                logfile = os.path.join(
+                    batchdir,
+                    f"{i + 1}-" + re.sub(r"[^\w.]+", "-", entry["name"]) + ".log",
+                )
+                futures.append(
+                    pool.submit(_run_diff_job, options, {"pdf": entry["pdf"]}, logfile)
                 )
-            else:
-                newfile = open(self.filelist[i], "w")
-                newfile.write(changedtext.decode("utf-8"))
-                newfile.close()
-                self.modifiedfiles += [self.filelist[i]]
 
-            os.remove(self.rev1filelist[i])
-            os.remove(self.rev2filelist[i])
+            for i in range(0, len(futures)):
+                result = results[i]
+                if futures[i] is not None:
+                    result.update(futures[i].result())
+                    # a pdf that was asked for but not built is a failure
+                    failed = result["returncode"] != 0 or (
+                        entries[i]["pdf"] == "y" and result["pdf"] is None
+                    )
+                    result["status"] = "failed" if failed else "built"
+                self.zprint(
+                    f"[{i + 1}/{len(entries)}] {result['name']} "
+                    + f"({result['rev1']}..{result['rev2']}): {result['status']}"
+                    + (f", {result['branch']}" if result["status"] == "built" else "")
+                )
 
-        self.generate_pdf(
-            "zaphod-diff-" + self.optionsDict["rev1"] + "-" + self.optionsDict["rev2"]
+        counts = {"built": 0, "skipped": 0, "failed": 0}
+        for result in results:
+            counts[result["status"]] += 1
+        summaryfile = os.path.join(batchdir, "summary.json")
+        with open(summaryfile, "w") as thisfile:
+            json.dump(
+                {
+                    "manifest": os.path.abspath(self.optionsDict["manifest"]),
+                    "counts": counts,
+                    "jobs": results,
+                },
+                thisfile,
+                indent=2,
+            )
+        self.zprint(
+            f"{counts['built']} built, {counts['skipped']} skipped, "
+            + f"{counts['failed']} failed."
+        )
+        self.zprint(f"Summary written to {summaryfile}")
+        if counts["failed"] > 0:
+            sys.exit(-8)
+
+    def generate_diffs(self):
+        """Run the diff engine on all files, in parallel."""
+        jobs = self.optionsDict["jobs"] or os.cpu_count() or 1
+        self.zprint(
+            f"Running {self.diffengine.name} on {len(self.filelist)} files "
+            + f"({jobs} jobs)."
+        )
+        failed = []
+        pool = None
+        size = sum(os.path.getsize(filename) for filename in self.rev2filelist)
+        workers = min(jobs, os.cpu_count() or 1)
+        if (
+            self.diffengine.name in ["native", "auto"]
+            and workers > 1
+            and size >= NativeEngine.processThreshold
+        ):
+            # the native engine holds the GIL, so it runs in worker processes,
+            # which are spawned since this process runs threads
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            self.diffengine.set_pool(pool)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                # map returns results in the order of filelist, so output and
+                # reporting do not depend on which latexdiff finishes first
+                results = executor.map(self.diff_file, range(0, len(self.filelist)))
+                for i, error in enumerate(results):
+                    if error is not None:
+                        self.logger.error(
+                            "Something went wrong "
+                            + f"- kept unannotated: {self.filelist[i]}\n{error}"
+                        )
+                        self.keep_unannotated(i)
+                        failed += [self.filelist[i]]
+                    else:
+                        self.modifiedfiles += [self.filelist[i]]
+        finally:
+            if pool is not None:
+                self.diffengine.set_pool(None)
+                pool.shutdown()
+
+        self.remove_rev_files()
+
+        if self.diffengine.name == "auto":
+            self.zprint(
+                f"Native engine: {self.diffengine.counts['native']} files, "
+                + f"latexdiff: {self.diffengine.counts['latexdiff']} files."
+            )
+        if len(failed) > 0:
+            self.zprint(
+                f"{self.diffengine.name} failed for {len(failed)} files, "
+                + "kept unannotated:"
+            )
+            for i in range(0, len(failed)):
+                print(f"[{(i + 1)}] {failed[i]}")
+            print()
+
+    def keep_unannotated(self, i):
+        """Put back the rev2 version of a file that could not be annotated.
+
+        When both revisions are checked out, the file was renamed for the
+        diff engine, so it would otherwise be missing from the annotated
+        branch.
+        """
+        target = self.filelist[i]
+        if self.outputdir or os.path.exists(target) or target in self.rev2missing:
+            return
+        shutil.copyfile(self.rev2filelist[i], target)
+
+    def remove_rev_files(self):
+        """Remove the copies of both revisions that latexdiff was run on."""
+        if self.scratchdir:
+            shutil.rmtree(self.scratchdir, ignore_errors=True)
+            self.scratchdir = None
+        # prepared revision files belong to the run that prepared them
+        elif not self.optionsDict.get("prepared"):
+            for filename in self.rev1filelist + self.rev2filelist:
+                os.remove(filename)
+
+    def diff_series(self):
+        """Diff each pair of adjacent commits in a range.
+
+        Each file version is written once to a shared directory for all
+        pairs. The pairs are then diffed in parallel worker processes, each
+        in its own worktree, with its own pdf and annotated branch.
+        """
+        if ".." not in self.optionsDict["series"]:
+            self.logger.error("Series must be a range: A..B")
+            sys.exit(-2)
+        start, end = self.optionsDict["series"].split("..", 1)
+        commits = self.git.rev_list(self.rev_parse(start), self.rev_parse(end))
+        revs = [self.rev_parse(start)] + commits
+        if len(revs) < 2:
+            self.zprint("No commits in range. Nothing to do.")
+            return
+
+        seriesid = self.timenow + "-" + uuid.uuid4().hex[:8]
+        seriesdir = os.path.join(self.get_zaphod_dir(), "series", seriesid)
+        os.makedirs(seriesdir, exist_ok=True)
+        blobdir = tempfile.mkdtemp(prefix="zaphod-series-")
+        mainfile = os.path.normpath(
+            os.path.join(self.optionsDict["subdir"], self.optionsDict["main"])
         )
 
-        subprocess.call(self.gitAddCommand)
+        try:
+            trees = {}
+            for rev in revs:
+                trees[rev] = self.get_rev_blobs(rev)
+                if self.optionsDict["follow_includes"]:
+                    included = self.get_rev_latex_files(rev)
+                    trees[rev] = {
+                        filename: blob
+                        for filename, blob in trees[rev].items()
+                        if filename in included
+                    }
+
+            # every version of a file is written only once for all pairs
+            blobfiles = {None: os.path.join(blobdir, "empty.tex")}
+            open(blobfiles[None], "w").close()
+
+            def blobfile(blob):
+                if blob not in blobfiles:
+                    blobfiles[blob] = os.path.join(blobdir, blob + ".tex")
+                    with open(blobfiles[blob], "wb") as thisfile:
+                        thisfile.write(self.git.read_object(blob))
+                return blobfiles[blob]
+
+            pairs = []
+            for i in range(0, len(revs) - 1):
+                tree1 = trees[revs[i]]
+                tree2 = trees[revs[i + 1]]
+                filelist = sorted(set(tree1) | set(tree2))
+                if not self.optionsDict["all_files"]:
+                    filelist = [
+                        filename
+                        for filename in filelist
+                        if tree1.get(filename) != tree2.get(filename)
+                        or os.path.normpath(filename) == mainfile
+                    ]
+                pairs.append(
+                    {
+                        "filelist": filelist,
+                        "rev1filelist": [blobfile(tree1.get(f)) for f in filelist],
+                        "rev2filelist": [blobfile(tree2.get(f)) for f in filelist],
+                    }
+                )
+        finally:
+            # worker processes must not share the batch processes
+            self.git.close()
+        self.zprint(
+            f"{len(pairs)} pairs of revisions, {len(blobfiles) - 1} file versions."
+        )
 
-        command = self.gitCommitCommand + [
-            "Save annotated changes between "
-            + self.optionsDict["rev1"]
-            + " and "
-            + self.optionsDict["rev2"]
-        ]
-        subprocess.call(command)
+        jobs = self.optionsDict["jobs"] or os.cpu_count() or 1
+        workers = min(jobs, len(pairs))
+        results = []
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = []
+                for i in range(0, len(pairs)):
+                    rev1 = revs[i][:10]
+                    rev2 = revs[i + 1][:10]
+                    options = dict(self.optionsDict)
+                    # bound methods can not be sent to worker processes
+                    options.pop("func", None)
+                    options.update(
+                        {
+                            "rev1": rev1,
+                            "rev2": rev2,
+                            "series": None,
+                            "worktree": True,
+                            "jobs": max(1, jobs // workers),
+                            "prepared": pairs[i],
+                        }
+                    )
+                    logfile = os.path.join(seriesdir, f"{i + 1}-{rev1}-{rev2}.log")
+                    futures.append(
+                        pool.submit(_run_diff_job, options, {"pdf": "y"}, logfile)
+                    )
 
-        self.zprint("The following branches have been created:")
-        self.zprint(self.rev1Branch + ": Revision 1.")
-        self.zprint(self.rev2Branch + ": Revision 2.")
-        self.zprint(self.finalBranch + ": Branch with annotated versions of sources")
+                for i in range(0, len(futures)):
+                    result = futures[i].result()
+                    result.update(
+                        {"index": i + 1, "rev1": revs[i], "rev2": revs[i + 1]}
+                    )
+                    results.append(result)
+                    status = "done" if result["returncode"] == 0 else "failed"
+                    self.zprint(
+                        f"[{i + 1}/{len(pairs)}] {revs[i][:10]}..{revs[i + 1][:10]}: "
+                        + f"{status}, {result['branch']}"
+                    )
+        finally:
+            shutil.rmtree(blobdir, ignore_errors=True)
+
+        indexfile = os.path.join(seriesdir, "index.json")
+        with open(indexfile, "w") as thisfile:
+            json.dump(
+                {"series": self.optionsDict["series"], "pairs": results}, thisfile
+            )
+        self.zprint(f"Series index written to {indexfile}")
+
+    def get_rev_blobs(self, rev):
+        """Get a dict of .tex file path to blob hash in a revision."""
+        blobs = self.git.list_blobs(rev, self.optionsDict["subdir"])
+        return {
+            filename: blob
+            for filename, blob in blobs.items()
+            if fnmatch.fnmatch(filename, "*.tex")
+        }
+
+    def diff_file(self, i):
+        """Run the diff engine on one file pair.
+
+        The annotated text is written to a temporary file next to the file,
+        which then replaces it, so that the output is not held in memory and
+        failed runs leave no partial files.
+
+        Returns None on success, and the error output on failure.
+        """
+        engine = self.diffengine
+        target = self.filelist[i]
+        if self.outputdir:
+            target = os.path.join(self.outputdir, target)
+        dirname = os.path.dirname(target)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmpname = self.temp_path(target)
+        with self.tracer.span(engine.name, "file", file=self.filelist[i]) as span:
+            if self.tracer.enabled:
+                span.set(
+                    bytes_in=os.path.getsize(self.rev1filelist[i])
+                    + os.path.getsize(self.rev2filelist[i])
+                )
+            try:
+                with open(tmpname, "xb") as outfile:
+                    cached = False
+                    if self.diffcache:
+                        key = self.diffcache.key(
+                            git_blob_hash(self.rev1filelist[i]),
+                            git_blob_hash(self.rev2filelist[i]),
+                            self.optionsDict["latexdiffopts"],
+                            engine.version(),
+                        )
+                        cached = self.diffcache.get(key, outfile)
+                    if not cached:
+                        engine.diff(self.rev1filelist[i], self.rev2filelist[i], outfile)
+                if cached:
+                    span.set(cached=True)
+                else:
+                    span.set(returncode=0)
+                    if self.diffcache:
+                        self.diffcache.put(key, tmpname)
+                span.set(bytes_out=os.path.getsize(tmpname))
+                os.replace(tmpname, target)
+            except DiffDeclined as E:
+                return f"Native diff engine declined: {E}"
+            except (subprocess.CalledProcessError, OSError) as E:
+                span.set(returncode=getattr(E, "returncode", None))
+                stderr = getattr(E, "stderr", None)
+                if stderr:
+                    return stderr.decode("utf-8", errors="replace")
+                return str(E)
+            finally:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+        return None
 
     def revise(self, args):
         """Do the revise part."""
         self.filelist = self.get_modified_latex_files()
         self.originalfilelist = self.filelist
+        if self.optionsDict["decisions"]:
+            self.load_decisions(self.optionsDict["decisions"])
+            # all files in one go, only hunks that no rule covers are asked
+            for filetorevise in list(self.filelist):
+                self.modified = False
+                self.revise_file(filetorevise)
+            self.zprint(
+                f"Decisions: {self.decisionCounts['y']} accepted, "
+                + f"{self.decisionCounts['n']} rejected by rules, "
+                + f"{self.decisionCounts['asked']} asked."
+            )
+
         while len(self.filelist) > 0:
             while True:
                 self.zprint("LaTeX files with annotations:")
@@ -301,318 +1294,552 @@ class Zaphod:
                 else:
                     self.zprint("Invalid input. Please try again.")
 
-            filetorevise = self.filelist[filenumber - 1]
-            filetext = ""
-            revisedfiletext = ""
-            # Token at the head of a token
-            head = 0
-            # Token at the tail of previous token
-            tail = 0
-            with open(filetorevise, "r") as thisfile:
-                filetext = thisfile.read()
-
-            while head < len(filetext):
-                # what's next - addition or deletion?
-                del_start = 0
-                delcheck = self.rxDelbegin.search(filetext[head:])
-                add_start = 0
-                addcheck = self.rxAddbegin.search(filetext[head:])
-                preamble_start = 0
-                preamblecheck = self.rxPreamble.search(filetext[head:])
-
-                if preamblecheck is None:
-                    preamble_start = len(filetext)
-                else:
-                    preamble_start = preamblecheck.start()
-                if delcheck is None:
-                    del_start = len(filetext)
-                else:
-                    del_start = delcheck.start()
-                if addcheck is None:
-                    add_start = len(filetext)
-                else:
-                    add_start = addcheck.start()
+            self.revise_file(self.filelist[filenumber - 1])
+            if self.optionsDict["background_pdf"] and len(self.filelist) > 0:
+                self.start_pdf_build("accepted")
 
-                # If both are at EOL
-                if add_start == del_start:
-                    revisedfiletext += filetext[head:]
-                    # print("{}, {}".format(del_start, add_start))
-                    break
+        # Only remove preamble when all files have been modified, otherwise,
+        # the pdf won't generate properly - no latexdiff commands will function
+        # without the preamble
+        self.remove_preamble()
+        self.generate_pdf("accepted")
+        self.save_changes()
 
-                # Skip preamble here - remove it at the end if required
-                if preamble_start < del_start and preamble_start < add_start:
-                    tail = head + preamblecheck.end()
-                    revisedfiletext += filetext[head:tail]
-                    head = tail
-                    # self.zprint("latexdiff preamble found and ignored.")
-                    continue
+    def revise_file(self, filetorevise):
+        """Revise all hunks in one file.
 
-                if del_start < add_start:
-                    # It's a deletion
-                    head = del_start + tail
-                    revisedfiletext += filetext[tail:head]
-                    tail = self.rxDelbegin.search(filetext[head:]).end() + head
-                    head = self.rxDelend.search(filetext[tail:]).start() + tail
-                    deletion = filetext[tail:head]
-                    deletion = re.sub(
-                        r"\\DIFdel\{(.*?)\}", r"\1", deletion, flags=re.DOTALL
-                    )
-                    print(f"====== {filetorevise} ======")
-                    print("--- Deletion found ---")
-                    print(deletion)
-                    print("--- Deletion found ---")
-                    while True:
-                        userinput = input("Accept deletion? Y/N/Q/y/n/q: ")
-                        if not userinput.isalpha():
-                            self.zprint("Invalid input. Try again.")
+        The file is memory mapped, and the revised text is written to a
+        temporary file as hunks are decided, which then replaces the file.
+        Only one hunk at a time is held in memory.
+        """
+        with self.tracer.span("revise file", "file", file=filetorevise) as span:
+            tmpname = self.temp_path(filetorevise)
+            try:
+                with (
+                    open(filetorevise, "rb") as thisfile,
+                    self.map_file(thisfile) as filedata,
+                    open(tmpname, "xb") as outputfile,
+                ):
+                    hunknumber = 0
+                    for hunk in self.iter_hunks(filedata):
+                        # Skip preamble here - remove it at the end if required
+                        if hunk.kind == "text" or hunk.kind == "preamble":
+                            self.copy_range(filedata, hunk.start, hunk.end, outputfile)
                             continue
 
-                        if userinput == "Y" or userinput == "y":
-                            self.zprint("Deletion accepted.")
-                            print()
+                        hunknumber += 1
+                        hunkid = f"{os.path.normpath(filetorevise)}:{hunknumber}"
+                        userinput = self.decide_hunk(hunkid, hunk)
+                        if userinput is None:
+                            userinput = self.ask_hunk(hunkid, hunk)
+
+                        if userinput == "y":
+                            if hunk.kind == "addition":
+                                outputfile.write(
+                                    hunk.payload.encode(
+                                        "utf-8", errors="surrogateescape"
+                                    )
+                                )
                             self.modified = True
-                            break
-                        elif userinput == "N" or userinput == "n":
-                            self.zprint("Ignored.")
-                            revisedfiletext += deletion
-                            break
-                        elif userinput == "Q" or userinput == "q":
-                            if self.modified:
-                                while True:
-                                    savepartial = input("Save partial file? Y/N/y/n: ")
-                                    if not savepartial.isalpha():
-                                        self.zprint("Invalid input." + "Try again.")
-                                        continue
-
-                                    if savepartial == "Y" or savepartial == "y":
-                                        revisedfiletext += filetext[head:]
-                                        outputfile = open(filetorevise, "w")
-                                        outputfile.write(revisedfiletext)
-                                        outputfile.close()
-                                        self.modifiedfiles += [filetorevise]
-                                        break
-                                    elif savepartial == "N" or savepartial == "n":
-                                        self.zprint("Discarding changes.")
-                                        break
-                                    else:
-                                        self.zprint("Invalid input. " + "Try again.")
-
-                            self.generate_pdf("accepted")
-                            self.save_changes()
+                        elif userinput == "n":
+                            if hunk.kind == "deletion":
+                                outputfile.write(
+                                    hunk.payload.encode(
+                                        "utf-8", errors="surrogateescape"
+                                    )
+                                )
                         else:
-                            self.zprint("Invalid input. Try again.")
-
-                    head = self.rxDelend.search(filetext[tail:]).end() + tail
-                    tail = head
-                else:
-                    # It's an addition
-                    head = add_start + tail
-                    revisedfiletext += filetext[tail:head]
-                    tail = self.rxAddbegin.search(filetext[head:]).end() + head
-                    head = self.rxAddend.search(filetext[tail:]).start() + tail
-                    addition = filetext[tail:head]
-                    addition = re.sub(
-                        r"\\DIFadd\{(.*?)\}", r"\1", addition, flags=re.DOTALL
-                    )
-                    print(f"====== {filetorevise} ======")
-                    print("+++ Addition found +++")
-                    print(addition)
-                    print("+++ Addition found +++")
-                    while True:
-                        userinput = input("Accept addition? Y/N/Q/y/n/q: ")
-                        if not userinput.isalpha():
-                            self.zprint("Invalid input. Try again.")
-                            continue
-
-                        if userinput == "Y" or userinput == "y":
-                            self.zprint("Addition accepted.")
-                            print()
-                            revisedfiletext += addition
-                            self.modified = True
-                            break
-                        elif userinput == "N" or userinput == "n":
-                            self.zprint("Ignored.")
-                            break
-                        elif userinput == "Q" or userinput == "q":
                             if self.modified:
-                                while True:
-                                    savepartial = input("Save partial file? Y/N/y/n: ")
-                                    if not savepartial.isalpha():
-                                        self.zprint("Invalid input." + " Try again.")
-                                        continue
-
-                                    if savepartial == "Y" or savepartial == "y":
-                                        revisedfiletext += filetext[head:]
-                                        outputfile = open(filetorevise, "w")
-                                        outputfile.write(revisedfiletext)
-                                        outputfile.close()
-                                        self.modifiedfiles += [filetorevise]
-                                        break
-                                    elif savepartial == "N" or savepartial == "n":
-                                        self.zprint("Discarding changes.")
-                                        break
-                                    else:
-                                        self.zprint("Invalid input. " + "Try again.")
+                                # keep this hunk and everything after it as is
+                                self.copy_range(
+                                    filedata, hunk.start, len(filedata), outputfile
+                                )
+                                outputfile.close()
+                                self.save_partial(filetorevise, tmpname)
 
                             self.remove_preamble()
                             self.generate_pdf("accepted")
                             self.save_changes()
-                        else:
-                            self.zprint("Invalid input. Try again.")
-                    head = self.rxAddend.search(filetext[tail:]).end() + tail
-                    tail = head
 
-            outputfile = open(filetorevise, "w")
-            outputfile.write(revisedfiletext)
-            outputfile.close()
+                    span.set(hunks=hunknumber)
+                shutil.copymode(filetorevise, tmpname)
+                os.replace(tmpname, filetorevise)
+            finally:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
             self.modifiedfiles += [filetorevise]
             self.zprint(f"File {filetorevise} revised and saved.")
             self.filelist.remove(filetorevise)
 
-        # Only remove preamble when all files have been modified, otherwise,
-        # the pdf won't generate properly - no latexdiff commands will function
-        # without the preamble
-        self.remove_preamble()
-        self.generate_pdf("accepted")
-        self.save_changes()
+    def temp_path(self, filename):
+        """Get a temporary file name next to filename, to replace it with."""
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, f".{basename}.{uuid.uuid4().hex[:8]}.tmp")
+
+    def map_file(self, thisfile):
+        """Memory map an open file for reading, as a context manager."""
+        # empty files can not be mapped
+        if os.fstat(thisfile.fileno()).st_size == 0:
+            return contextlib.nullcontext(b"")
+        return mmap.mmap(thisfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def copy_range(self, filedata, start, end, outputfile):
+        """Copy part of a memory mapped file to outputfile, block by block."""
+        for blockstart in range(start, end, self.copyBlockSize):
+            outputfile.write(
+                filedata[blockstart : min(end, blockstart + self.copyBlockSize)]
+            )
+
+    def load_decisions(self, decisionsfile):
+        """Load rules to accept or reject hunks from a JSON or YAML file.
+
+        The file contains a list of "rules". Each rule has an "action",
+        "accept" or "reject", and any of: "files" (glob on the file path),
+        "kind" ("addition" or "deletion"), "match" (regular expression
+        searched in the hunk text), and "hunk" (hunk id, path:number). The
+        first rule whose criteria all match decides a hunk.
+
+        Optional "pdf" (true/false) and "commit" (commit message, or false)
+        keys answer the final prompts.
+        """
+        decisions = self.load_data_file(decisionsfile, "decisions")
+
+        self.decisionRules = []
+        for rule in decisions.get("rules", []):
+            if rule.get("action") not in ["accept", "reject"]:
+                self.logger.error(f"Rule without accept/reject action: {rule}")
+                sys.exit(-7)
+            if rule.get("kind") not in [None, "addition", "deletion"]:
+                self.logger.error(f"Rule with unknown hunk kind: {rule}")
+                sys.exit(-7)
+            rule = dict(rule)
+            if "match" in rule:
+                rule["match"] = re.compile(rule["match"])
+            if "files" in rule:
+                rule["files"] = os.path.normpath(rule["files"])
+            self.decisionRules.append(rule)
+
+        if "pdf" in decisions:
+            self.answers["pdf"] = "y" if decisions["pdf"] else "n"
+        if "commit" in decisions:
+            if decisions["commit"]:
+                self.answers["commit"] = "y"
+                self.answers["message"] = decisions["commit"]
+            else:
+                self.answers["commit"] = "n"
+
+    def load_data_file(self, filename, description):
+        """Load a JSON or YAML file, by its extension.
+
+        :param description: what the file is, for error messages
+        """
+        try:
+            with open(filename, "r") as thisfile:
+                if filename.endswith((".yaml", ".yml")):
+                    if yaml is None:
+                        self.logger.error(
+                            f"PyYAML is required to read YAML {description} files."
+                        )
+                        sys.exit(-7)
+                    data = yaml.safe_load(thisfile)
+                else:
+                    data = json.load(thisfile)
+        except (OSError, ValueError) as E:
+            self.logger.error(f"Could not read {description} file {filename}: {E}")
+            sys.exit(-7)
+        # yaml errors are not ValueErrors
+        except Exception as E:
+            self.logger.error(f"Could not parse {description} file {filename}: {E}")
+            sys.exit(-7)
+        if not isinstance(data, dict):
+            self.logger.error(f"The {description} file {filename} is not a mapping.")
+            sys.exit(-7)
+        return data
+
+    def decide_hunk(self, hunkid, hunk):
+        """Decide a hunk using the loaded rules: returns y, n, or None."""
+        for rule in self.decisionRules:
+            if "hunk" in rule and rule["hunk"] != hunkid:
+                continue
+            if "kind" in rule and rule["kind"] != hunk.kind:
+                continue
+            if "files" in rule and not fnmatch.fnmatch(
+                hunkid.rsplit(":", 1)[0], rule["files"]
+            ):
+                continue
+            if "match" in rule and rule["match"].search(hunk.payload) is None:
+                continue
+
+            decision = "y" if rule["action"] == "accept" else "n"
+            self.decisionCounts[decision] += 1
+            return decision
+
+        self.decisionCounts["asked"] += 1
+        return None
+
+    def iter_hunks(self, filedata):
+        """Split annotated text into hunks in a single pass.
+
+        Yields Hunk tuples of kind "text", "preamble", "deletion" or
+        "addition", with their byte span in filedata, which may be a memory
+        mapped file. Text and preamble hunks have no payload, so that they
+        can be copied without being read into memory. The payload of
+        additions and deletions is decoded, and has the \\DIFadd{} or
+        \\DIFdel{} commands removed.
+        """
+        pos = 0
+        while True:
+            match = self.rxHunk.search(filedata, pos)
+            if match is None:
+                break
+
+            kind = match.lastgroup
+            if kind == "preamble":
+                end = match.end()
+                payload = None
+            else:
+                if kind == "deletion":
+                    endmatch = self.rxDelend.search(filedata, match.end())
+                    command = "\\DIFdel"
+                else:
+                    endmatch = self.rxAddend.search(filedata, match.end())
+                    command = "\\DIFadd"
+                # not terminated: leave the rest of the file as it is
+                if endmatch is None:
+                    break
+                end = endmatch.end()
+                payload = self.strip_command(
+                    filedata[match.end() : endmatch.start()].decode(
+                        "utf-8", errors="surrogateescape"
+                    ),
+                    command,
+                )
+
+            if match.start() > pos:
+                yield Hunk("text", pos, match.start(), None)
+            yield Hunk(kind, match.start(), end, payload)
+            pos = end
+
+        if pos < len(filedata):
+            yield Hunk("text", pos, len(filedata), None)
+
+    def strip_command(self, text, command):
+        """Replace all command{argument} in text with argument.
+
+        Braces are matched, so arguments may contain nested groups.
+        """
+        opener = command + "{"
+        stripped = []
+        pos = 0
+        while True:
+            start = text.find(opener, pos)
+            if start == -1:
+                break
+            depth = 1
+            for brace in self.rxBrace.finditer(text, start + len(opener)):
+                if brace.group() == "{":
+                    depth += 1
+                elif brace.group() == "}":
+                    depth -= 1
+                    if depth == 0:
+                        break
+            # unbalanced: leave the rest untouched
+            if depth != 0:
+                break
+            stripped.append(text[pos:start])
+            stripped.append(text[start + len(opener) : brace.start()])
+            pos = brace.end()
+
+        stripped.append(text[pos:])
+        return "".join(stripped)
+
+    def ask_hunk(self, hunkid, hunk):
+        """Ask whether to accept a hunk: returns y, n, or q."""
+        if hunk.kind == "deletion":
+            name = "Deletion"
+            marker = "---"
+        else:
+            name = "Addition"
+            marker = "+++"
+        print(f"====== {hunkid} ======")
+        print(f"{marker} {name} found {marker}")
+        print(hunk.payload)
+        print(f"{marker} {name} found {marker}")
+        while True:
+            userinput = input(f"Accept {name.lower()}? Y/N/Q/y/n/q: ")
+            if not userinput.isalpha():
+                self.zprint("Invalid input. Try again.")
+                continue
+
+            if userinput == "Y" or userinput == "y":
+                self.zprint(f"{name} accepted.")
+                print()
+                return "y"
+            elif userinput == "N" or userinput == "n":
+                self.zprint("Ignored.")
+                return "n"
+            elif userinput == "Q" or userinput == "q":
+                return "q"
+            else:
+                self.zprint("Invalid input. Try again.")
+
+    def save_partial(self, filetorevise, partialfile):
+        """Ask whether to replace a file with its partially revised version."""
+        while True:
+            savepartial = input("Save partial file? Y/N/y/n: ")
+            if not savepartial.isalpha():
+                self.zprint("Invalid input. Try again.")
+                continue
+
+            if savepartial == "Y" or savepartial == "y":
+                shutil.copymode(filetorevise, partialfile)
+                os.replace(partialfile, filetorevise)
+                self.modifiedfiles += [filetorevise]
+                break
+            elif savepartial == "N" or savepartial == "n":
+                self.zprint("Discarding changes.")
+                break
+            else:
+                self.zprint("Invalid input. Try again.")
 
     def clean(self, args):
         """
         Remove all branches created by Zaphod.
+
+        Branches are listed with a single for-each-ref call, and deleted in
+        one ref transaction. Branches that are checked out in a worktree are
+        always kept. Runs are the branches created by one diff, and are
+        dated by the time in their names. Runs of the same minute are
+        ordered by the commit time of their annotated branches.
         """
         self.zprint("Getting branch list.")
-        command = self.gitBranchCommand
-        ps = subprocess.check_output(command)
-
-        branches = ps.decode("ascii").split("\n")
-        zaphodBranches = 0
-        for line in branches:
-            branchName = line.strip().replace("* ", "")
-            if self.branchSpec in branchName:
-                zaphodBranches += 1
-                self.zprint(f"Found a zaphod branch: {branchName}")
-                command = self.gitBranchDeleteCommand + [branchName]
-                if self.optionsDict["yes"]:
-                    self.zprint(f"Deleting branch {branchName}")
-                    subprocess.call(command)
-                else:
-                    deletebranch = input("Delete branch? Y/y/N/n: ")
-                    if deletebranch == "Y" or deletebranch == "y":
-                        subprocess.call(command)
-                    else:
-                        self.zprint(f"Skipping branch {branchName}")
-
-        if zaphodBranches == 0:
+        branches = self.get_zaphod_branches()
+        if len(branches) == 0:
             self.zprint("No Zaphod branches found.")
+            return
+
+        checkedout = self.git.worktree_branches()
+        # (date, tie break) of each run
+        rundates = {}
+        for branch in branches:
+            date, tiebreak = rundates.get(branch["run"], (branch["date"], 0.0))
+            # the annotated commit is made by the run, the revisions are not
+            if branch["name"].endswith("annotated"):
+                tiebreak = branch["committed"]
+            rundates[branch["run"]] = (date, tiebreak)
+        # newest runs first
+        runs = sorted(
+            rundates.items(),
+            key=lambda run: (run[1], run[0]),
+            reverse=True,
+        )
+        keptruns = [run for run, date in runs[: self.optionsDict["keep"]]]
+        cutoff = None
+        if self.optionsDict["older_than"] is not None:
+            cutoff = time.time() - self.optionsDict["older_than"] * 24 * 60 * 60
+
+        delete = []
+        keep = []
+        for branch in branches:
+            if branch["ref"] in checkedout:
+                keep.append((branch, "checked out in a worktree"))
+            elif branch["run"] in keptruns:
+                keep.append((branch, f"one of the newest {len(keptruns)} runs"))
+            elif cutoff is not None and branch["date"] > cutoff:
+                keep.append(
+                    (branch, f"newer than {self.optionsDict['older_than']:g} days")
+                )
+            else:
+                delete.append(branch)
+
+        for branch, reason in keep:
+            self.zprint(f"Keeping {branch['name']}: {reason}")
+        for branch in delete:
+            self.zprint(
+                ("Would delete " if self.optionsDict["dry_run"] else "Deleting ")
+                + f"{branch['name']} "
+                + f"({datetime.datetime.fromtimestamp(branch['date']):%Y-%m-%d %H:%M})"
+            )
+        self.zprint(
+            f"{len(branches)} Zaphod branches in {len(runs)} runs: "
+            + f"{len(delete)} to delete, {len(keep)} to keep."
+        )
+        if len(delete) == 0 or self.optionsDict["dry_run"]:
+            return
 
-    def remove_preamble(self):
-        """Remove latexdiff preamble when all files have been revised."""
-        # Confirm that no files now have annotations
-        modifiedfiles = self.get_modified_latex_files()
-        if len(modifiedfiles) == 0:
-            self.zprint("All files have been revised.")
-            self.zprint("Removing latexdiff preamble additions.")
-            for filetorevise in self.modifiedfiles:
-                with open(filetorevise, "r") as thisfile:
-                    filetext = thisfile.read()
-
-                # Replace preamble additions
-                filetext = re.sub(
-                    pattern=self.rPreamble, repl="", string=filetext, flags=re.DOTALL
+        if not self.optionsDict["yes"]:
+            deletebranches = input(f"Delete {len(delete)} branches? Y/y/N/n: ")
+            if deletebranches != "Y" and deletebranches != "y":
+                self.zprint("Not deleting any branches.")
+                return
+
+        self.delete_branches(delete)
+        self.zprint(f"Deleted {len(delete)} branches.")
+
+    def get_zaphod_branches(self):
+        """Get the branches created by Zaphod.
+
+        :returns: list of dicts with the "ref", "name", "objectname", the
+            "run" the branch belongs to, its creation "date" as a
+            timestamp, and the "committed" timestamp of its commit
+        """
+        branches = []
+        for ref, objectname, committerdate in self.git.branches():
+            name = ref[len("refs/heads/") :]
+            if self.branchSpec not in name:
+                continue
+            # branch names start with the time of the run
+            try:
+                date = datetime.datetime.strptime(name[:12], "%Y%m%d%H%M").timestamp()
+            except ValueError:
+                date = committerdate
+            branches.append(
+                {
+                    "ref": ref,
+                    "name": name,
+                    "objectname": objectname,
+                    "run": re.sub(r"-?(rev1|rev2|annotated)$", "", name),
+                    "date": date,
+                    "committed": committerdate,
+                }
+            )
+        return branches
+
+    def delete_branches(self, branches):
+        """Delete branches in a single ref transaction.
+
+        Each ref is only deleted if it still points to the commit it was
+        listed with, and either all or none of the refs are deleted.
+        """
+        try:
+            self.git.delete_refs(
+                [(branch["ref"], branch["objectname"]) for branch in branches]
+            )
+        except subprocess.CalledProcessError:
+            self.logger.error("Could not delete branches: no branches were deleted.")
+            sys.exit(-9)
+
+    def cache(self, args):
+        """Show statistics for or prune the latexdiff and pdf caches."""
+        self.zprint(
+            f"Cache directory: {os.path.abspath(self.optionsDict['cache_dir'])}"
+        )
+        for name, cache, limit in [
+            (
+                "latexdiff",
+                DiffCache(
+                    self.optionsDict["cache_dir"],
+                    self.optionsDict["cache_size"] * 1024 * 1024,
+                ),
+                self.optionsDict["cache_size"],
+            ),
+            (
+                "pdf",
+                PdfCache(
+                    self.optionsDict["cache_dir"],
+                    self.optionsDict["pdf_cache_size"] * 1024 * 1024,
+                ),
+                self.optionsDict["pdf_cache_size"],
+            ),
+        ]:
+            if self.optionsDict["action"] == "prune":
+                removed, freed = cache.prune()
+                self.zprint(
+                    f"Removed {removed} {name} entries, "
+                    + f"freed {freed / (1024 * 1024):.1f} MB."
                 )
 
-                outputfile = open(filetorevise, "w")
-                outputfile.write(filetext)
-                outputfile.close()
-        else:
-            self.zprint("Some files still have latexdiff annotations:")
-            for i in range(0, len(modifiedfiles)):
-                print(f"[{(i + 1)}] {modifiedfiles[i]}")
-            print()
+            stats = cache.load_stats()
+            self.zprint(f"{name}: {len(cache.entries())} entries")
+            self.zprint(
+                f"{name}: size {cache.size() / (1024 * 1024):.1f} MB "
+                + f"(limit: {limit} MB)"
+            )
+            self.zprint(f"{name}: hits: {stats['hits']}, misses: {stats['misses']}")
+
+    def remove_preamble(self):
+        """Remove latexdiff preamble when all files have been revised."""
+        with self.tracer.span("remove preamble"):
+            # Confirm that no files now have annotations
+            modifiedfiles = self.get_modified_latex_files()
+            if len(modifiedfiles) == 0:
+                self.zprint("All files have been revised.")
+                self.zprint("Removing latexdiff preamble additions.")
+                for filetorevise in self.modifiedfiles:
+                    tmpname = self.temp_path(filetorevise)
+                    try:
+                        with (
+                            open(filetorevise, "rb") as thisfile,
+                            self.map_file(thisfile) as filedata,
+                        ):
+                            preamble = self.rxPreamble.search(filedata)
+                            if preamble is None:
+                                continue
+                            # Copy everything around the preamble additions
+                            with open(tmpname, "xb") as outputfile:
+                                self.copy_range(
+                                    filedata, 0, preamble.start(), outputfile
+                                )
+                                self.copy_range(
+                                    filedata, preamble.end(), len(filedata), outputfile
+                                )
+                        shutil.copymode(filetorevise, tmpname)
+                        os.replace(tmpname, filetorevise)
+                    finally:
+                        if os.path.exists(tmpname):
+                            os.remove(tmpname)
+            else:
+                self.zprint("Some files still have latexdiff annotations:")
+                for i in range(0, len(modifiedfiles)):
+                    print(f"[{(i + 1)}] {modifiedfiles[i]}")
+                print()
 
     def save_changes(self):
         """Commit changes."""
-        if len(self.modifiedfiles) > 0:
-            self.zprint("Following files have been revised (maybe partially):")
-            for i in range(0, len(self.modifiedfiles)):
-                print(f"[{(i + 1)}] {self.modifiedfiles[i]}")
+        with self.tracer.span("save changes"):
+            self.wait_for_pdf()
+            if len(self.modifiedfiles) > 0:
+                self.zprint("Following files have been revised (maybe partially):")
+                for i in range(0, len(self.modifiedfiles)):
+                    print(f"[{(i + 1)}] {self.modifiedfiles[i]}")
 
-            print()
-            while True:
-                savechanges = input("Commit current changes? Y/y/N/n: ")
-                if savechanges == "y" or savechanges == "Y":
-                    subprocess.call(self.gitAddCommand)
-                    commitmessage = input("Enter commit message: ")
-
-                    command = self.gitCommitCommand + [commitmessage]
-                    subprocess.call(command)
-                    self.zprint("Changes committed.\n")
-                    break
-                elif savechanges == "n" or savechanges == "N":
-                    self.zprint("Exiting without committing.")
-                    break
-                else:
-                    self.zprint("Invalid input. Please try again.")
-        else:
-            self.zprint("No files modified. Exiting.")
+                print()
+                while True:
+                    savechanges = self.answers.get("commit") or input(
+                        "Commit current changes? Y/y/N/n: "
+                    )
+                    if savechanges == "y" or savechanges == "Y":
+                        self.git.stage(self.modifiedfiles + self.builtfiles)
+                        commitmessage = self.answers.get("message") or input(
+                            "Enter commit message: "
+                        )
 
-        sys.exit(0)
+                        self.git.commit(commitmessage)
+                        self.zprint("Changes committed.\n")
+                        break
+                    elif savechanges == "n" or savechanges == "N":
+                        self.zprint("Exiting without committing.")
+                        break
+                    else:
+                        self.zprint("Invalid input. Please try again.")
+            else:
+                self.zprint("No files modified. Exiting.")
+
+            sys.exit(0)
 
     def generate_pdf(self, filename):
         """Generate pdf file."""
         if len(self.modifiedfiles) > 0:
             while True:
-                generatepdf = input("Generate pdf? Y/y/N/n: ")
+                generatepdf = self.answers.get("pdf") or input(
+                    "Generate pdf? Y/y/N/n: "
+                )
 
                 if generatepdf == "Y" or generatepdf == "y":
-                    self.zprint("Removing temporary files")
-                    command = (
-                        self.latexmkCleanCommand
-                        + ("-jobname=" + filename).split()
-                        + [self.optionsDict["main"]]
-                    )
-                    try:
-                        subprocess.check_call(command, cwd=self.optionsDict["subdir"])
-                    except subprocess.CalledProcessError as E:
-                        self.zprint("latexmk -c failed. Output below:")
-                        if E.output:
-                            print(E.output)
-                        if E.stderr:
-                            print(E.stderr)
-                        return -1
-
-                    if self.optionsDict["citations"]:
-                        self.zprint("User has specified citations")
-                        command = (
-                            self.latexmkCommand
-                            + self.bibFlag
-                            + ("-jobname=" + filename).split()
-                            + [self.optionsDict["main"]]
-                        )
+                    if self.optionsDict.get("background_pdf"):
+                        self.start_pdf_build(filename)
                     else:
-                        command = (
-                            self.latexmkCommand
-                            + self.nobibFlag
-                            + ("-jobname=" + filename).split()
-                            + [self.optionsDict["main"]]
-                        )
-                    try:
-                        subprocess.check_call(command, cwd=self.optionsDict["subdir"])
-                    except subprocess.CalledProcessError as E:
-                        self.zprint("pdflatex failed. Output below:")
-                        if E.output:
-                            print(E.output)
-                        if E.stderr:
-                            print(E.stderr)
-                        return -1
-
-                    self.zprint(
-                        "PDF generated: "
-                        + self.optionsDict["subdir"]
-                        + "/"
-                        + filename
-                        + ".pdf"
-                    )
+                        self.build_pdf(filename)
                     break
                 elif generatepdf == "N" or generatepdf == "n":
                     self.zprint("Not generating pdf.")
@@ -620,64 +1847,486 @@ class Zaphod:
                 else:
                     self.zprint("Invalid input. Please try again.")
 
+    def build_pdf(self, filename, generation=None):
+        """Build the pdf file, or restore it from the pdf cache.
+
+        In incremental mode, the build files are kept in a separate output
+        directory for each jobname, so that latexmk only runs the passes
+        that are needed. They are only removed when a clean build is
+        requested or after a failed build.
+
+        Background builds pass their generation number, and write latexmk
+        output to a log file instead of the terminal.
+
+        With --changed-only, builds are incremental, and only the included
+        units with changes are compiled where possible.
+
+        :returns: 0 on success, -1 on failure, None if superseded
+        """
+        with self.tracer.span("build pdf", jobname=filename):
+            wrapper = None
+            try:
+                if self.optionsDict.get("changed_only"):
+                    wrapper = self.write_changed_units_main(filename)
+                return self.build_main(
+                    filename, wrapper or self.optionsDict["main"], generation
+                )
+            finally:
+                if wrapper is not None:
+                    os.remove(os.path.join(self.optionsDict["subdir"], wrapper))
+
+    def build_main(self, filename, mainfile, generation=None):
+        """Build the pdf file of a main file, or restore it from the cache.
+
+        :param mainfile: main file in the subdirectory to run latexmk on
+        :returns: 0 on success, -1 on failure, None if superseded
+        """
+        logfile = None
+        if generation is not None:
+            os.makedirs(self.get_zaphod_dir(), exist_ok=True)
+            logfile = os.path.join(self.get_zaphod_dir(), filename + "-build.log")
+            open(logfile, "w").close()
+
+        outdir = None
+        if self.optionsDict.get("incremental") or self.optionsDict.get("changed_only"):
+            outdir = os.path.join(
+                self.get_zaphod_dir(),
+                "build",
+                _build_dirname(self.optionsDict, filename),
+            )
+            os.makedirs(outdir, exist_ok=True)
+
+        if self.optionsDict["citations"]:
+            if generation is None:
+                self.zprint("User has specified citations")
+            bibflag = self.bibFlag
+        else:
+            bibflag = self.nobibFlag
+
+        builtpdf = os.path.join(self.optionsDict["subdir"], filename + ".pdf")
+        synctex = os.path.join(self.optionsDict["subdir"], filename + ".synctex.gz")
+        builddir = os.path.abspath(self.optionsDict["subdir"])
+        pdfcache = None
+        restored = False
+        if not self.optionsDict.get("no_pdf_cache"):
+            pdfcache = PdfCache(
+                self.optionsDict.get("cache_dir") or default_cache_dir(),
+                self.optionsDict.get("pdf_cache_size", 1024) * 1024 * 1024,
+            )
+            buildkey = pdfcache.build_key(
+                filename, mainfile, self.latexmkCommand + bibflag
+            )
+            with self.tracer.span("pdf cache") as span:
+                restored = pdfcache.get(buildkey, builddir, builtpdf, synctex)
+                span.set(cached=restored)
+
+        if restored:
+            self.zprint(f"Restored {filename}.pdf from the pdf cache.")
+        else:
+            started = time.time()
+            returncode = self.compile_pdf(
+                filename, mainfile, outdir, bibflag, generation, logfile
+            )
+            if returncode != 0:
+                return returncode
+            flsfile = os.path.join(outdir or builddir, filename + ".fls")
+            if pdfcache and os.path.isfile(flsfile) and os.path.isfile(builtpdf):
+                pdfcache.put(
+                    buildkey,
+                    builddir,
+                    recorded_inputs(flsfile, filename, outdir),
+                    builtpdf,
+                    synctex,
+                    started,
+                )
+        if pdfcache:
+            pdfcache.save_stats()
+            pdfcache.prune()
+        self.builtfiles += self.get_built_files(filename, outdir)
+
+        if self.worktree and os.path.isfile(builtpdf):
+            # the worktree is removed at the end of the run
+            pdfdir = os.path.join(self.get_zaphod_dir(), "pdf")
+            os.makedirs(pdfdir, exist_ok=True)
+            shutil.copy2(builtpdf, os.path.join(pdfdir, self.finalBranch + ".pdf"))
+            self.zprint(
+                "PDF generated: " + os.path.join(pdfdir, self.finalBranch + ".pdf")
+            )
+            return 0
+
+        self.zprint(
+            "PDF generated: " + self.optionsDict["subdir"] + "/" + filename + ".pdf"
+        )
+        return 0
+
+    def write_changed_units_main(self, filename):
+        """Write a main file that only compiles the changed included units.
+
+        The units of the document, the files that it \\include's, that have
+        files in self.modifiedfiles are listed in \\includeonly. LaTeX reads
+        the .aux files of the other units from the last build, so that
+        references to them still resolve.
+
+        :returns: name of the new main file in the subdirectory, or None if
+            the whole document has to be built
+        """
+        subdir = self.optionsDict["subdir"]
+        if self.includegraph is None:
+            self.includegraph = IncludeGraph(
+                os.path.join(self.get_zaphod_dir(), "includes.json")
+            )
+
+        def read(path):
+            try:
+                with open(path, "rb") as thisfile:
+                    return thisfile.read()
+            except OSError:
+                return None
+
+        units = self.includegraph.units(
+            os.path.join(subdir, self.optionsDict["main"]), read
+        )
+        self.includegraph.save()
+        if len(units) == 0:
+            self.zprint("No included units found: building the whole document.")
+            return None
+
+        modified = {os.path.normpath(filename) for filename in self.modifiedfiles}
+        changed = [unit for unit, files in units.items() if modified & set(files)]
+        if len(changed) == len(units):
+            return None
+        auxdir = os.path.join(
+            self.get_zaphod_dir(), "build", _build_dirname(self.optionsDict, filename)
+        )
+        missing = [
+            unit
+            for unit in units
+            if unit not in changed
+            and not os.path.isfile(
+                os.path.join(auxdir, os.path.splitext(unit)[0] + ".aux")
+            )
+        ]
+        if len(missing) > 0:
+            self.zprint(
+                f"{len(missing)} unchanged units have not been built yet: "
+                + "building the whole document."
+            )
+            return None
+
+        self.zprint(
+            f"Building {len(changed)} of {len(units)} included units: "
+            + (", ".join(changed) or "none")
+        )
+        wrapper = f"{filename}-includeonly.tex"
+        with open(os.path.join(subdir, wrapper), "w") as thisfile:
+            thisfile.write(f"\\includeonly{{{','.join(changed)}}}\n")
+            thisfile.write(f"\\input{{{self.optionsDict['main']}}}\n")
+        return wrapper
+
+    def get_built_files(self, filename, outdir):
+        """Get the files that a pdf build wrote next to the sources.
+
+        These are committed with the sources, so that the working tree is
+        left clean.
+
+        :param outdir: output directory for incremental builds, or None
+        """
+        subdir = self.optionsDict["subdir"]
+        builtfiles = [
+            os.path.join(subdir, name)
+            for name in os.listdir(subdir)
+            if name.startswith(filename + ".")
+        ]
+        flsfile = os.path.join(subdir, filename + ".fls")
+        if outdir is None and os.path.isfile(flsfile):
+            # for example the .aux files of \include'd files
+            builtfiles += [
+                os.path.join(subdir, name) for name in recorded_outputs(flsfile)
+            ]
+        return builtfiles
+
+    def compile_pdf(
+        self, filename, mainfile, outdir, bibflag, generation=None, logfile=None
+    ):
+        """Run latexmk to compile the pdf file.
+
+        :param mainfile: main file in the subdirectory
+        :param outdir: output directory for incremental builds, or None
+        :param bibflag: latexmk flag for bibliographies
+        :returns: 0 on success, -1 on failure, None if superseded
+        """
+        outdirflag = ["-outdir=" + outdir] if outdir else []
+        if outdir is None or self.optionsDict.get("clean_build"):
+            if generation is None:
+                self.zprint("Removing temporary files")
+            returncode = self.clean_pdf_build(
+                filename, mainfile, outdirflag, generation, logfile
+            )
+            if returncode != 0:
+                return returncode
+
+        command = (
+            self.latexmkCommand
+            + bibflag
+            + outdirflag
+            + ("-jobname=" + filename).split()
+            + [mainfile]
+        )
+        returncode = self.run_latexmk(command, generation, logfile)
+        if returncode is None:
+            return None
+        if returncode != 0:
+            self.zprint("pdflatex failed.")
+            if logfile:
+                self.zprint(f"Output is in {logfile}")
+            # do not let the next build start from a broken state
+            if outdir:
+                self.clean_pdf_build(
+                    filename, mainfile, outdirflag, generation, logfile
+                )
+            return -1
+
+        if outdir:
+            # put the pdf where it would be without an output directory
+            for extension in [".pdf", ".synctex.gz"]:
+                built = os.path.join(outdir, filename + extension)
+                if os.path.isfile(built):
+                    shutil.copy2(
+                        built,
+                        os.path.join(self.optionsDict["subdir"], filename + extension),
+                    )
+        return 0
+
+    def clean_pdf_build(
+        self, filename, mainfile, outdirflag, generation=None, logfile=None
+    ):
+        """Remove all latexmk generated files for a jobname."""
+        command = (
+            self.latexmkCleanCommand
+            + outdirflag
+            + ("-jobname=" + filename).split()
+            + [mainfile]
+        )
+        returncode = self.run_latexmk(command, generation, logfile)
+        if returncode is None:
+            return None
+        if returncode != 0:
+            self.zprint("latexmk -c failed.")
+            if logfile:
+                self.zprint(f"Output is in {logfile}")
+            return -1
+        return 0
+
+    def run_latexmk(self, command, generation=None, logfile=None):
+        """Run a latexmk command in the subdirectory.
+
+        :returns: the exit code, or None if the build it belongs to has been
+            superseded by a newer one
+        """
+        with self.tracer.command_span(command, {}) as span:
+            output = None
+            if logfile:
+                output = open(logfile, "a")
+            try:
+                with self.buildLock:
+                    if generation is not None and generation != self.buildGeneration:
+                        return None
+                    # in its own process group so that pdflatex and bibtex are
+                    # stopped too when the build is cancelled
+                    process = subprocess.Popen(
+                        command,
+                        cwd=self.optionsDict["subdir"],
+                        stdout=output,
+                        stderr=subprocess.STDOUT if output else None,
+                        start_new_session=True,
+                    )
+                    self.buildProcess = process
+                returncode = process.wait()
+                span.set(returncode=returncode)
+            finally:
+                if output:
+                    output.close()
+
+            with self.buildLock:
+                self.buildProcess = None
+                if generation is not None and generation != self.buildGeneration:
+                    return None
+            return returncode
+
+    def start_pdf_build(self, filename):
+        """Build the pdf in a background thread.
+
+        A build that is still running is cancelled: only the latest
+        request matters.
+        """
+        self.cancel_pdf_build()
+        with self.buildLock:
+            generation = self.buildGeneration
+        self.zprint(f"Building {filename}.pdf in the background.")
+        self.buildThread = threading.Thread(
+            target=self.build_pdf, args=(filename, generation), daemon=True
+        )
+        self.buildThread.start()
+
+    def cancel_pdf_build(self):
+        """Stop a running background build."""
+        with self.buildLock:
+            # any build with an older generation is now stale
+            self.buildGeneration += 1
+            if self.buildProcess is not None and self.buildProcess.poll() is None:
+                if hasattr(os, "killpg"):
+                    os.killpg(self.buildProcess.pid, signal.SIGTERM)
+                else:
+                    self.buildProcess.terminate()
+        if self.buildThread is not None:
+            self.buildThread.join()
+            self.buildThread = None
+
+    def wait_for_pdf(self):
+        """Wait for the last background build to finish."""
+        if self.buildThread is not None:
+            self.zprint("Waiting for the pdf build to finish.")
+            self.buildThread.join()
+            self.buildThread = None
+
     def get_latex_files(self):
         """Get list of files with extension .tex."""
-        filelist = []
-        for root, dirs, files in os.walk(self.optionsDict["subdir"]):
-            for filename in fnmatch.filter(files, "*.tex"):
-                if filename not in filelist:
-                    filelist.append(os.path.join(root, filename))
+        with self.tracer.span("discover files"):
+            if self.optionsDict.get("follow_includes"):
 
-        if not len(filelist) > 0:
-            print("No tex files found in this directory", file=sys.stderr)
-            sys.exit(-1)
-        # print(filelist)
+                def read(filename):
+                    try:
+                        with open(filename, "rb") as thisfile:
+                            return thisfile.read()
+                    except OSError:
+                        return None
+
+                return self.get_included_files(read)
+
+            filelist = []
+            for root, dirs, files in os.walk(self.optionsDict["subdir"]):
+                for filename in fnmatch.filter(files, "*.tex"):
+                    if filename not in filelist:
+                        filelist.append(os.path.join(root, filename))
+
+            if not len(filelist) > 0:
+                print("No tex files found in this directory", file=sys.stderr)
+                sys.exit(-1)
+            # print(filelist)
+            return filelist
+
+    def get_rev_latex_files(self, rev):
+        """Get list of files with extension .tex in a revision."""
+        if self.optionsDict["follow_includes"]:
+
+            def read(filename):
+                return self.git.read_file(rev, filename)
+
+            return self.get_included_files(read)
+
+        return list(self.get_rev_blobs(rev))
+
+    def get_included_files(self, read):
+        """Get the files reachable from the main file through its includes.
+
+        :param read: function that returns the contents of a file, or None
+        """
+        if self.includegraph is None:
+            self.includegraph = IncludeGraph(
+                os.path.join(self.get_zaphod_dir(), "includes.json")
+            )
+        mainfile = os.path.join(self.optionsDict["subdir"], self.optionsDict["main"])
+        filelist = self.includegraph.files(mainfile, read)
+        self.includegraph.save()
+        self.zprint(f"Found {len(filelist)} files included from {mainfile}.")
         return filelist
 
-    def get_modified_latex_files(self):
-        """Get list of files with latexdiff annotations."""
-        filelist = []
-        modified_filelist = []
-        for root, dirs, files in os.walk(self.optionsDict["subdir"]):
-            for filename in fnmatch.filter(files, "*.tex"):
-                if filename not in filelist:
-                    filelist.append(os.path.join(root, filename))
-
-        if not len(filelist) > 0:
-            print("No tex files found in this directory", file=sys.stderr)
-            sys.exit(-1)
+    def get_changed_latex_files(self, rev1, rev2, subdir=None):
+        """Get files with extension .tex that differ between two revisions.
 
-        for i in range(0, len(filelist)):
-            filetorevise = filelist[i]
+        :param subdir: subdirectory to look in, default: the --subdir option
+        """
+        changes = self.git.changed_files(
+            rev1, rev2, subdir or self.optionsDict["subdir"]
+        )
+        return {
+            os.path.normpath(filename): status
+            for filename, status in changes.items()
+            if fnmatch.fnmatch(filename, "*.tex")
+        }
+
+    def filter_unchanged_files(self, rev1, rev2):
+        """Only keep files that changed between the revisions in the file list.
+
+        The main file is always kept so that it gets the latexdiff preamble.
+        """
+        if self.optionsDict["all_files"]:
+            return
+
+        changes = self.get_changed_latex_files(rev1, rev2)
+        mainfile = os.path.normpath(
+            os.path.join(self.optionsDict["subdir"], self.optionsDict["main"])
+        )
+        worklist = []
+        for filename in self.filelist:
+            if os.path.normpath(filename) in changes:
+                worklist.append(filename)
+            elif os.path.normpath(filename) == mainfile:
+                worklist.append(filename)
+
+        statuses = list(changes.values())
+        self.zprint(
+            f"{statuses.count('A')} added, {statuses.count('M')} modified, "
+            + f"{statuses.count('D')} deleted files."
+        )
+        self.zprint(
+            f"Skipping {len(self.filelist) - len(worklist)} unchanged files: "
+            + "these are not passed to latexdiff."
+        )
+        self.filelist = worklist
 
-            with open(filetorevise, "r") as thisfile:
-                filetext = thisfile.read()
+    def rev_parse(self, rev):
+        """Get the commit a revision points to."""
+        commit = self.git.rev_parse(rev)
+        if commit is None:
+            self.logger.error(f"Revision {rev} not found! Exiting!")
+            sys.exit(-2)
+        return commit
 
-            # Ignore preamble
-            filetext = re.sub(
-                pattern=self.rPreamble, repl="", string=filetext, flags=re.DOTALL
+    def get_modified_latex_files(self):
+        """Get list of files with latexdiff annotations."""
+        with self.tracer.span("scan annotations"):
+            filelist = []
+            modified_filelist = []
+            for root, dirs, files in os.walk(self.optionsDict["subdir"]):
+                for filename in fnmatch.filter(files, "*.tex"):
+                    if filename not in filelist:
+                        filelist.append(os.path.join(root, filename))
+
+            if not len(filelist) > 0:
+                print("No tex files found in this directory", file=sys.stderr)
+                sys.exit(-1)
+
+            if self.annotationindex is None:
+                self.annotationindex = AnnotationIndex(
+                    os.path.join(self.get_zaphod_dir(), "annotations.json")
+                )
+            hunks = self.annotationindex.update(
+                filelist, self.optionsDict.get("jobs") or os.cpu_count() or 1
             )
+            self.annotationindex.save()
 
-            # Check for annotations
-            del_start = 0
-            delcheck = self.rxDelbegin.search(filetext[:])
-            add_start = 0
-            addcheck = self.rxAddbegin.search(filetext[:])
-            if delcheck is None:
-                del_start = len(filetext)
-            else:
-                del_start = delcheck.start()
-            if addcheck is None:
-                add_start = len(filetext)
-            else:
-                add_start = addcheck.start()
+            for filetorevise in filelist:
+                # Only add to filelist if there are latexdiff annotations
+                if len(hunks[filetorevise]) > 0:
+                    modified_filelist += [filetorevise]
 
-            # Only add to filelist if both aren't EOL (no latexdiff annotations
-            # if they are)
-            if not add_start == del_start:
-                modified_filelist += [filetorevise]
+            return modified_filelist
 
-        return modified_filelist
+    def get_zaphod_dir(self):
+        """Get the directory in the git directory where Zaphod keeps state."""
+        # shared between all worktrees
+        return os.path.join(self.git.common_dir(), "zaphod")
 
     def generate_rev_filenames(self, rev):
         """Rename files as required for diff."""
@@ -699,6 +2348,22 @@ class Zaphod:
         self.parser.add_argument(
             "-h", "--help", action=_HelpAction, help="View subcommand help"
         )
+        self.parser.add_argument(
+            "--git-backend",
+            choices=list(BACKENDS),
+            default="subprocess",
+            help="How to run git. subprocess: git commands, with long \
+            running processes to read objects. dulwich: read objects, trees \
+            and branches in process with dulwich",
+        )
+        self.parser.add_argument(
+            "--trace",
+            metavar="FILE",
+            action="store",
+            default=None,
+            help="Write the times taken by each stage and subprocess to FILE, in \
+            Chrome trace event format, and print the slowest ones",
+        )
 
         self.subparser = self.parser.add_subparsers(help="additional help")
 
@@ -738,6 +2403,36 @@ class Zaphod:
                                         Will run pdflatex and bibtex as \
                                         required. \nDefault: False",
         )
+        self.revise_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            action="store",
+            help="Number of processes to scan files for annotations \
+                                        with, when there are enough large \
+                                        files to scan.\n\
+                                        Default: number of CPUs",
+        )
+        self.revise_parser.add_argument(
+            "-b",
+            "--background-pdf",
+            action="store_true",
+            default=False,
+            help="Build the pdf in the background after each file is \
+                                        revised, while revision continues.\n\
+                                        Default: False",
+        )
+        self.revise_parser.add_argument(
+            "-d",
+            "--decisions",
+            action="store",
+            default=None,
+            help="JSON or YAML file with rules to accept or reject \
+                                        hunks. Only hunks that no rule covers \
+                                        are asked about.\n\
+                                        Default: None",
+        )
 
         self.diff_parser = self.subparser.add_parser(
             "diff",
@@ -799,6 +2494,293 @@ class Zaphod:
                                       Will add -bibtex to latexmk.\n\
                                       Default: True",
         )
+        self.diff_parser.add_argument(
+            "--no-checkout",
+            action="store_true",
+            default=False,
+            help="Read both revisions straight from the git object \
+                                      store instead of checking them out. \
+                                      Only the annotated branch is checked \
+                                      out.\n\
+                                      Default: False",
+        )
+        self.diff_parser.add_argument(
+            "-a",
+            "--all-files",
+            action="store_true",
+            default=False,
+            help="Run latexdiff on all files, including ones that have \
+                                      not changed between the revisions.\n\
+                                      Default: False",
+        )
+        self.diff_parser.add_argument(
+            "--series",
+            action="store",
+            default=None,
+            help="Range of commits, A..B. Generate an annotated branch \
+                                      and pdf for each pair of adjacent \
+                                      commits, following first parents, \
+                                      in parallel worktrees. \
+                                      Overrides --rev1 and --rev2.\n\
+                                      Default: None",
+        )
+        self.diff_parser.add_argument(
+            "-w",
+            "--worktree",
+            action="store_true",
+            default=False,
+            help="Work in a temporary git worktree instead of the \
+                                      current working tree, so that several \
+                                      runs can happen at once. Implies \
+                                      --no-checkout.\n\
+                                      Default: False",
+        )
+        self.diff_parser.add_argument(
+            "-f",
+            "--follow-includes",
+            action="store_true",
+            default=False,
+            help="Only diff files reached from the main file through \
+                                      \\input, \\include, \\subfile and \
+                                      \\import, instead of all .tex files in \
+                                      the subdirectory.\n\
+                                      Default: False",
+        )
+        self.diff_parser.add_argument(
+            "-e",
+            "--engine",
+            choices=list(ENGINES),
+            default="latexdiff",
+            help="Engine to annotate changes with. latexdiff: run latexdiff.\n\
+                                      native: word level diff in Python, much\n\
+                                      faster for prose, but declines changes\n\
+                                      to commands, math, comments and the\n\
+                                      preamble. auto: native, and latexdiff\n\
+                                      for the files that it declines, with\n\
+                                      the preamble extension from latexdiff.\n\
+                                      Default: latexdiff",
+        )
+        self.diff_parser.add_argument(
+            "--split-sections",
+            metavar="MB",
+            nargs="?",
+            type=float,
+            const=1.0,
+            default=None,
+            help="Diff files larger than MB megabytes in parts split at\n\
+                                      \\part, \\chapter and \\section headings, or\n\
+                                      at top level environments, in parallel.\n\
+                                      Unchanged parts are not diffed.\n\
+                                      Default: off, 1 MB if no size is given",
+        )
+        self.diff_parser.add_argument(
+            "--stats",
+            metavar="FILE",
+            nargs="?",
+            const="-",
+            default=None,
+            help="Only write the numbers of added and deleted hunks,\n\
+                                      words and bytes per file and section as\n\
+                                      JSON to FILE, or to stdout. No branches\n\
+                                      are created and no pdf is built.\n\
+                                      Default: off, stdout if no file is given",
+        )
+        self.diff_parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            default=False,
+            help="Do not use the latexdiff cache.\n\
+                                      Default: False",
+        )
+        self.diff_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            action="store",
+            help="Number of latexdiff processes to run in parallel. \
+                                      The native engine runs in up to as \
+                                      many worker processes, when there \
+                                      are several MB of files to diff.\n\
+                                      Default: number of CPUs",
+        )
+
+        for pdf_parser in [self.revise_parser, self.diff_parser]:
+            pdf_parser.add_argument(
+                "-i",
+                "--incremental",
+                action="store_true",
+                default=False,
+                help="Keep latexmk build files between runs in \
+                                          .git/zaphod/build so that only the \
+                                          required passes are run.\n\
+                                          Default: False",
+            )
+            pdf_parser.add_argument(
+                "--clean-build",
+                action="store_true",
+                default=False,
+                help="Remove latexmk build files before building, also in \
+                                          incremental mode.\n\
+                                          Default: False",
+            )
+            pdf_parser.add_argument(
+                "--changed-only",
+                action="store_true",
+                default=False,
+                help="Only compile the \\include'd units that have changes, \
+                                          with \\includeonly, and reuse the \
+                                          .aux files of the others from the \
+                                          last build. Implies --incremental.\n\
+                                          Default: False",
+            )
+            pdf_parser.add_argument(
+                "--no-pdf-cache",
+                action="store_true",
+                default=False,
+                help="Always run latexmk, instead of restoring pdfs whose \
+                                          inputs have not changed from the \
+                                          pdf cache.\n\
+                                          Default: False",
+            )
+
+        self.cache_parser = self.subparser.add_parser(
+            "cache",
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            help="Manage the latexdiff and pdf caches\n",
+        )
+        self.cache_parser.set_defaults(func=self.cache, needs_repo=False)
+        self.cache_parser.add_argument(
+            "action",
+            choices=["stats", "prune"],
+            help="stats: show cache statistics\n\
+                                       prune: remove entries until the cache \
+                                       fits its size limit",
+        )
+        for cache_parser in [self.revise_parser, self.diff_parser, self.cache_parser]:
+            cache_parser.add_argument(
+                "--cache-dir",
+                default=default_cache_dir(),
+                action="store",
+                help="Directory to keep the latexdiff and pdf caches in.\n\
+                                          Default: $XDG_CACHE_HOME/zaphod",
+            )
+            cache_parser.add_argument(
+                "--pdf-cache-size",
+                default=1024,
+                type=int,
+                action="store",
+                help="Maximum size of the pdf cache in MB. \
+                                          Least recently used entries are \
+                                          removed first.\n\
+                                          Default: 1024",
+            )
+        for cache_parser in [self.diff_parser, self.cache_parser]:
+            cache_parser.add_argument(
+                "--cache-size",
+                default=512,
+                type=int,
+                action="store",
+                help="Maximum size of the latexdiff cache in MB. \
+                                          Least recently used entries are \
+                                          removed first.\n\
+                                          Default: 512",
+            )
+
+        self.serve_parser = self.subparser.add_parser(
+            "serve",
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            help="Run diff and compile jobs sent over HTTP\n",
+        )
+        # jobs run in worktrees and do not touch the working tree
+        self.serve_parser.set_defaults(func=self.serve, worktree=True)
+        serve_address = self.serve_parser.add_mutually_exclusive_group(required=True)
+        serve_address.add_argument(
+            "-p",
+            "--port",
+            type=int,
+            default=None,
+            action="store",
+            help="TCP port to listen on.",
+        )
+        serve_address.add_argument(
+            "-u",
+            "--socket",
+            default=None,
+            action="store",
+            help="Unix socket to listen on.",
+        )
+        self.serve_parser.add_argument(
+            "--host",
+            default="127.0.0.1",
+            action="store",
+            help="Address to listen on with --port.\n\
+                                       Default: 127.0.0.1",
+        )
+        self.serve_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            action="store",
+            help="Number of jobs to run at the same time.\n\
+                                       Default: number of CPUs",
+        )
+
+        self.batch_parser = self.subparser.add_parser(
+            "batch",
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            help="Run the diffs listed in a manifest without prompts\n",
+        )
+        # jobs run in worktrees and do not touch the working tree
+        self.batch_parser.set_defaults(func=self.batch, worktree=True)
+        self.batch_parser.add_argument(
+            "manifest",
+            action="store",
+            help="JSON or YAML file listing the diffs to run.",
+        )
+        self.batch_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            action="store",
+            help="Number of diffs to run at the same time.\n\
+                                       Default: number of CPUs",
+        )
+
+        self.stats_parser = self.subparser.add_parser(
+            "stats",
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            help="Show change statistics of annotated files\n",
+        )
+        # only reads files, so the working tree may have changes
+        self.stats_parser.set_defaults(func=self.stats, stats=True)
+        self.stats_parser.add_argument(
+            "-s",
+            "--subdir",
+            default=".",
+            action="store",
+            help="Name of subdirectory with the annotated files.\n\
+                                       Default: .",
+        )
+        self.stats_parser.add_argument(
+            "-o",
+            "--output",
+            default="-",
+            action="store",
+            help="File to write the JSON statistics to.\n\
+                                       Default: stdout",
+        )
+        self.stats_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            action="store",
+            help="Number of files to scan for annotations in parallel.\n\
+                                       Default: number of CPUs",
+        )
 
         self.clean_parser = self.subparser.add_parser(
             "clean",
@@ -816,15 +2798,44 @@ class Zaphod:
                                        this option. \
                                        Default: False",
         )
+        self.clean_parser.add_argument(
+            "-k",
+            "--keep",
+            type=int,
+            default=0,
+            action="store",
+            help="Keep the branches of the newest KEEP runs.\n\
+                                       Default: 0",
+        )
+        self.clean_parser.add_argument(
+            "-o",
+            "--older-than",
+            metavar="DAYS",
+            type=float,
+            default=None,
+            action="store",
+            help="Only delete branches created more than DAYS days \
+                                       ago.\n\
+                                       Default: None",
+        )
+        self.clean_parser.add_argument(
+            "-n",
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Only report which branches would be deleted and \
+                                       which would be kept.\n\
+                                       Default: False",
+        )
 
     def check_setup(self):
         """Check if Git directory is clean."""
-        command = "git status --porcelain".split()
-        ps = subprocess.check_output(command)
+        ps = self.git.status()
         rpModified = re.compile(r"^\s*M")
         rpUntracked = re.compile(r"^\s*\?\?")
 
-        if (
+        # worktree and stats runs do not touch the working tree
+        if not (self.optionsDict.get("worktree") or self.optionsDict.get("stats")) and (
             rpModified.search(ps.decode("ascii")) is not None
             or rpUntracked.search(ps.decode("ascii")) is not None
         ):
@@ -864,19 +2875,44 @@ class Zaphod:
             )
             sys.exit(-4)
 
+        skipped = []
+        # the native diff engine does not need latexdiff
+        if self.optionsDict.get("engine") == "native":
+            skipped.append("latexdiff")
+        # statistics are counted without building a pdf
+        if self.optionsDict.get("stats"):
+            skipped.append("pdflatex")
+            if "engine" not in self.optionsDict:
+                skipped.append("latexdiff")
         for command in self.commandList:
-            if not shutil.which(command):
+            if command in skipped:
+                continue
+            self.tools[command] = shutil.which(command)
+            if not self.tools[command]:
                 self.logger.error(command + " not found! Exiting!", file=sys.stderr)
                 sys.exit(-5)
 
         if (
             "citations" in self.optionsDict
             and self.optionsDict["citations"]
+            and not self.optionsDict.get("stats")
             and not shutil.which("bibtex")
         ):
             self.logger.error("bibtex not found! Exiting!", file=sys.stderr)
             sys.exit(-6)
 
+    def use_git_backend(self):
+        """Set up the git backend given in the options."""
+        name = self.optionsDict.get("git_backend") or "subprocess"
+        if name not in BACKENDS:
+            self.logger.error(f"Unknown git backend: {name}")
+            sys.exit(-5)
+        try:
+            self.git = BACKENDS[name](self.tracer)
+        except GitError as E:
+            self.logger.error(str(E))
+            sys.exit(-5)
+
     def zprint(self, message):
         """Prepend all output messages with token."""
         print("[Zaphod] " + message)
@@ -889,11 +2925,25 @@ class Zaphod:
 
         self.options = self.parser.parse_args()
         self.optionsDict = vars(self.options)
-        if len(self.optionsDict) != 0:
-            # Check for latex files and get a list
-            self.check_setup()
-            #  print(self.optionsDict)
-            self.options.func(self.options)
+        # only global options, such as --trace, and no subcommand
+        if "func" in self.optionsDict:
+            self.tracer = Tracer(self.optionsDict.get("trace"))
+            self.use_git_backend()
+            try:
+                # Check for latex files and get a list
+                if self.optionsDict.get("needs_repo", True):
+                    with self.tracer.span("check setup"):
+                        self.check_setup()
+                #  print(self.optionsDict)
+                with self.tracer.span(self.options.func.__name__):
+                    self.options.func(self.options)
+            finally:
+                # also when a subcommand exits
+                self.git.close()
+                # on stderr, so that it does not mix with JSON output
+                if self.git.spawned > 0:
+                    self.logger.info(self.git.report())
+                self.tracer.write()
 
 
 def cli():